@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""Hourly indexed archive of correlated transactions, and lookups in it.
+
+Rows are grouped by the hour of their @timestamp into two files per hour in
+the archive directory:
+
+  YYYY-MM-DD.HH.blocks  zlib compressed blocks of up to BLOCK_ROWS rows, each
+                        a JSON list of columns (see COLUMNS)
+  YYYY-MM-DD.HH.index   one JSON line per block: its offset and length, row
+                        count, first and last epoch second, and a bloom
+                        filter each over the srcip, host and url values in it
+
+A query reads the index of each hour in its time range and only reads the
+blocks whose time range overlaps and whose filters may hold every value
+asked for.
+
+A block is written once it has BLOCK_ROWS rows or its first row has waited
+BLOCK_SECONDS, and on close. Rows still waiting are lost if the process dies,
+so the archive is for lookups; the text output stays the full record.
+
+Usage: python archive.py query /path/to/archive [--from 2020-01-01T10:00] [--to ...]
+                              [--srcip 10.0.0.1] [--host example.com] [--url /path]
+"""
+import os, sys, time, json, zlib, base64, struct, hashlib, logging, argparse, operator, calendar
+import decode, formats
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ("epoch", "timestamp", "srcip", "dstip", "txid", "method", "url", "referer", "useragent", "host", "status", "size")
+INDEXED = ("srcip", "host", "url")
+BLOCK_ROWS = 4096
+BLOCK_SECONDS = 60
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 7
+
+# extract a row of COLUMNS from a transactions.Transaction
+row = operator.attrgetter(*COLUMNS)
+unpack_digest = struct.Struct("<QQ").unpack
+
+def hour_name(epoch):
+    return time.strftime("%Y-%m-%d.%H", time.gmtime(epoch))
+
+def key_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, formats.STRING_TYPES):
+        value = u"%s" % value
+    return value.encode("utf-8")
+
+class Bloom(object):
+    """A bloom filter over strings. Bit positions come from an md5 digest so
+    they are the same on every platform and Python version."""
+    def __init__(self, bits, hashes=BLOOM_HASHES, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray((bits + 7) // 8) if data is None else bytearray(data)
+
+    @classmethod
+    def of(cls, values):
+        bloom = cls(max(64, len(values) * BLOOM_BITS_PER_KEY))
+        # add() inlined, as this runs for every value archived
+        bits, data, ks, md5 = bloom.bits, bloom.data, range(bloom.hashes), hashlib.md5
+        for value in values:
+            h1, h2 = unpack_digest(md5(key_bytes(value)).digest())
+            for i in ks:
+                p = (h1 + i * h2) % bits
+                data[p >> 3] |= 1 << (p & 7)
+        return bloom
+
+    def positions(self, value):
+        h1, h2 = unpack_digest(hashlib.md5(key_bytes(value)).digest())
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+    def add(self, value):
+        data = self.data
+        for p in self.positions(value):
+            data[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, value):
+        for p in self.positions(value):
+            if not self.data[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def as_json(self):
+        return {"bits": self.bits, "hashes": self.hashes, "data": base64.b64encode(bytes(self.data)).decode("ascii")}
+
+    @classmethod
+    def from_json(cls, saved):
+        return cls(saved["bits"], saved["hashes"], base64.b64decode(saved["data"]))
+
+class Archive(object):
+    """Writes rows (see row()) into the hourly block and index files."""
+    def __init__(self, path, block_rows=BLOCK_ROWS, block_seconds=BLOCK_SECONDS):
+        self.path = path
+        self.block_rows = block_rows
+        self.block_seconds = block_seconds
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # hour -> rows waiting for a block, and when the first one arrived
+        self._pending = {}
+        self._since = {}
+        self._checked = time.time()
+        # index files already checked for a torn last line
+        self._repaired = set()
+
+    def add(self, rows):
+        for r in rows:
+            hour = r[0] - r[0] % 3600
+            pending = self._pending.get(hour)
+            if pending is None:
+                pending = self._pending[hour] = []
+                self._since[hour] = time.time()
+            pending.append(r)
+            if len(pending) >= self.block_rows:
+                self.write_block(hour)
+        # waiting blocks only need looking at about once a second
+        if time.time() - self._checked >= 1:
+            self.age()
+
+    def age(self):
+        """Write the blocks whose first row has waited block_seconds. add()
+        does this as rows arrive; writers call it regularly as well, so the
+        last block of a quiet spell is not held indefinitely."""
+        now = time.time()
+        self._checked = now
+        for hour, since in list(self._since.items()):
+            if now - since >= self.block_seconds:
+                self.write_block(hour)
+
+    def flush(self):
+        for hour in sorted(self._pending):
+            self.write_block(hour)
+
+    def close(self):
+        self.flush()
+
+    def write_block(self, hour):
+        rows = self._pending.pop(hour)
+        del self._since[hour]
+        columns = list(zip(*rows))
+        data = zlib.compress(json.dumps(columns, separators=(",", ":")).encode("utf-8"))
+        blooms = {}
+        for name in INDEXED:
+            values = set(columns[COLUMNS.index(name)])
+            values.discard(None)
+            blooms[name] = Bloom.of(values).as_json()
+        base = os.path.join(self.path, hour_name(hour))
+        with open(base + ".blocks", 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+        # the block is in place before the index line that points at it
+        entry = {"offset": offset, "length": len(data), "rows": len(rows),
+                 "start": min(columns[0]), "end": max(columns[0]), "bloom": blooms}
+        if base not in self._repaired:
+            repair_index(base + ".index")
+            self._repaired.add(base)
+        with open(base + ".index", 'ab') as f:
+            f.write((json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8"))
+        logger.debug("Archived {0} rows at {1} in {2}.blocks".format(len(rows), offset, base))
+
+def repair_index(path):
+    """Drop a line left torn at the end of an index file by a crash, so the
+    next entry appended starts on a line of its own."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if not size:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        f.seek(0)
+        good = f.read().rfind(b"\n") + 1
+        logger.info("Dropping incomplete entry at the end of {0}".format(path))
+        f.truncate(good)
+
+def read_index(path):
+    """Yield the entries of an index file, skipping torn lines."""
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                entry = decode.loads(line)
+            except ValueError:
+                logger.warning("Skipping unreadable entry in {0}".format(path))
+                continue
+            yield entry
+
+def read_block(f, entry):
+    f.seek(entry["offset"])
+    columns = decode.loads(zlib.decompress(f.read(entry["length"])))
+    return zip(*columns)
+
+def query(path, start=None, end=None, match=None, stats=None):
+    """Yield the archived rows with start <= epoch <= end whose fields equal
+    every value in match, a dict keyed by column name. stats, if given, is
+    a dict updated with the numbers of hours, blocks and blocks read."""
+    match = match or {}
+    if stats is None:
+        stats = {}
+    for k in ("hours", "blocks", "read"):
+        stats.setdefault(k, 0)
+    checks = [(COLUMNS.index(name), value) for name, value in match.items()]
+    hours = []
+    for name in os.listdir(path):
+        if not name.endswith(".index"):
+            continue
+        hour = calendar.timegm(time.strptime(name[:-len(".index")], "%Y-%m-%d.%H"))
+        if (end is None or hour <= end) and (start is None or hour + 3600 > start):
+            hours.append((hour, name[:-len(".index")]))
+    for hour, name in sorted(hours):
+        stats["hours"] += 1
+        base = os.path.join(path, name)
+        with open(base + ".blocks", 'rb') as f:
+            for entry in read_index(base + ".index"):
+                stats["blocks"] += 1
+                if (end is not None and entry["start"] > end) or (start is not None and entry["end"] < start):
+                    continue
+                blooms = entry["bloom"]
+                if any(value not in Bloom.from_json(blooms[field]) for field, value in match.items() if field in blooms):
+                    continue
+                stats["read"] += 1
+                for r in read_block(f, entry):
+                    if start is not None and r[0] < start:
+                        continue
+                    if end is not None and r[0] > end:
+                        continue
+                    for i, value in checks:
+                        if r[i] != value:
+                            break
+                    else:
+                        yield r
+
+TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H", "%Y-%m-%d")
+
+def parse_time(text):
+    """Return the epoch seconds for a UTC time given as epoch seconds or as
+    an ISO 8601 date and time without a zone."""
+    if text.isdigit():
+        return int(text)
+    for fmt in TIME_FORMATS:
+        try:
+            return calendar.timegm(time.strptime(text.rstrip("Z"), fmt))
+        except ValueError:
+            pass
+    raise ValueError("Unrecognised time {0}".format(text))
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command")
+
+    qp = sub.add_parser("query", help="Print archived transactions matching every given condition")
+    qp.add_argument("archivepath", help="Archive directory written by watch.py --archive")
+    qp.add_argument("--from", dest="start", help="Earliest @timestamp, UTC, as 2020-01-01T10:00:00 or epoch seconds")
+    qp.add_argument("--to", dest="end", help="Latest @timestamp, UTC, as 2020-01-01T10:05:00 or epoch seconds")
+    qp.add_argument("--srcip", dest="srcip", help="Source IPv4 address")
+    qp.add_argument("--host", dest="host", help="HTTP host")
+    qp.add_argument("--url", dest="url", help="HTTP request URL, matched exactly")
+    qp.add_argument("-f", "--format", dest="format", default="apache", choices=sorted(formats.FORMATS), help="Output format")
+    qp.add_argument("--fields", dest="fields", help="Comma separated fields to output, for formats other than apache")
+    qp.add_argument("-l", dest="loglevel", default="INFO")
+
+    p = parser.parse_args()
+    if p.command != "query":
+        parser.print_help()
+        return
+
+    lvl = getattr(logging, p.loglevel)
+    ch = logging.StreamHandler()
+    ch.setLevel(lvl)
+    ch.setFormatter(logging.Formatter('%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    logger.setLevel(lvl)
+    logger.addHandler(ch)
+
+    try:
+        formatter = formats.formatter(p.format, p.fields)
+        start = parse_time(p.start) if p.start else None
+        end = parse_time(p.end) if p.end else None
+    except ValueError as e:
+        qp.error(str(e))
+    match = dict((name, getattr(p, name)) for name in INDEXED if getattr(p, name))
+
+    columns = [COLUMNS.index(formats.FIELDS[field][0]) for field in formatter.fields]
+    out = sys.stdout
+    if formatter.binary:
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+    stats = {}
+    found = 0
+    for r in query(p.archivepath, start, end, match, stats):
+        out.write(formatter.render([r[i] for i in columns]) + formatter.newline)
+        found += 1
+    out.flush()
+    logger.info("{0} matching rows from {1} of {2} blocks in {3} hours".format(found, stats["read"], stats["blocks"], stats["hours"]))
+
+if __name__ == "__main__":
+    main()
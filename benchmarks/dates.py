@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""Compare cached and uncached @timestamp conversion.
+
+Usage: python -m benchmarks.dates [-n records] [--per-second n]
+"""
+import time
+import timeit
+import argparse
+import formats
+
+def make_timestamps(count, per_second):
+    start = 1577872800 # 2020-01-01T10:00:00Z
+    stamps = []
+    for i in range(count):
+        t = time.gmtime(start + i // per_second)
+        stamps.append("{0}.{1:03d}Z".format(time.strftime('%Y-%m-%dT%H:%M:%S', t), i % 1000))
+    return stamps
+
+def run(func, stamps, repeat):
+    def loop():
+        for s in stamps:
+            func(s)
+    return min(timeit.repeat(loop, number=1, repeat=repeat))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="count", default=100000, type=int, help="Number of timestamps to convert")
+    parser.add_argument("--per-second", dest="per_second", default=500, type=int, help="Records sharing each second")
+    parser.add_argument("-r", dest="repeat", default=3, type=int, help="Repetitions (best is reported)")
+    p = parser.parse_args()
+
+    stamps = make_timestamps(p.count, p.per_second)
+    for s in stamps[::p.per_second]:
+        assert formats.reformat_date(s) == formats.convert_date(s)
+
+    uncached = run(formats.convert_date, stamps, p.repeat)
+    formats._date_cache.clear()
+    cached = run(formats.reformat_date, stamps, p.repeat)
+
+    print("{0} timestamps, {1} per second".format(p.count, p.per_second))
+    print("convert_date:  {0:.3f}s ({1:.0f}/s)".format(uncached, p.count / uncached))
+    print("reformat_date: {0:.3f}s ({1:.0f}/s)".format(cached, p.count / cached))
+    print("speedup: {0:.1f}x".format(uncached / cached))
+
+if __name__ == "__main__":
+    main()
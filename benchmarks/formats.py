@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""Measure the cost of each output format per line.
+
+Formats correlated transactions built from generated records, from both
+transactions.Transaction objects (as watch.py does) and decoded Logstash
+records (as ipfixout.py does).
+
+Usage: python -m benchmarks.formats [-n records] [-f apache,json]
+"""
+import timeit
+import argparse
+
+import formats
+import transactions
+from benchmarks import generate
+
+def make_records(count):
+    gen = generate.RecordGenerator(drop_ratio=0, corrupt_ratio=0)
+    requests = {}
+    records = []
+    for record in gen.records(count * 3, 1577872800):
+        netflow = record["netflow"]
+        if "netscalerHttpReqMethod" in netflow:
+            requests[netflow["netscalerTransactionId"]] = record
+        elif "netscalerHttpRspStatus" in netflow:
+            request = requests.pop(netflow["netscalerTransactionId"], None)
+            if request is not None:
+                request["netflow"]["netscalerHttpRspStatus"] = netflow["netscalerHttpRspStatus"]
+                request["netflow"]["netscalerHttpRspLen"] = netflow["netscalerHttpRspLen"]
+                records.append(request)
+    return records[:count]
+
+def run(func, records, repeat):
+    def loop():
+        for r in records:
+            func(r)
+    return min(timeit.repeat(loop, number=1, repeat=repeat))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="count", default=100000, type=int, help="Number of transactions to format")
+    parser.add_argument("-f", dest="formats", default=",".join(sorted(formats.FORMATS)), help="Comma separated formats to run")
+    parser.add_argument("-r", dest="repeat", default=3, type=int, help="Repetitions (best is reported)")
+    p = parser.parse_args()
+
+    records = make_records(p.count)
+    txs = [transactions.Transaction.from_json(r) for r in records]
+    print("{0:<8} {1:>14} {2:>14}".format("format", "transaction/s", "logstash/s"))
+    for name in p.formats.split(","):
+        formatter = formats.formatter(name)
+        tx = run(formatter.format, txs, p.repeat)
+        js = run(formatter.format_json, records, p.repeat)
+        print("{0:<8} {1:>14.0f} {2:>14.0f}".format(name, len(txs) / tx, len(records) / js))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""Generate synthetic Logstash AppFlow output for benchmarking.
+
+Writes one <YYYY-mm-dd.HH>_json.log file per hour in the shape Logstash's
+netflow codec produces for Netscaler AppFlow: a mix of non-HTTP L4 flows,
+HTTP request records and HTTP response records. Responses are delayed by a
+random number of records so they can arrive out of order, a fraction of
+responses are never sent, and a fraction of requests carry a corrupt method.
+
+Usage: python -m benchmarks.generate outdir [-n records] [options]
+"""
+import os
+import json
+import time
+import random
+import heapq
+import argparse
+
+METHODS = ("GET", "GET", "GET", "GET", "POST", "POST", "HEAD", "OPTIONS")
+CORRUPT_METHODS = (u"G\u0000T", "PO", u"\u00e9\u00e9", "")
+HOSTS = ["www.example.com", "api.example.com", "static.example.net", "login.example.org", "cdn.example.io"]
+AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/78.0.3904.108 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_1) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.0.3 Safari/605.1.15",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:70.0) Gecko/20100101 Firefox/70.0",
+    "curl/7.58.0",
+]
+STATUSES = (200, 200, 200, 200, 200, 304, 302, 404, 500)
+
+class RecordGenerator(object):
+    def __init__(self, seed=1, http_ratio=0.4, drop_ratio=0.02, corrupt_ratio=0.005, max_delay=200, rate=2000):
+        self.random = random.Random(seed)
+        self.http_ratio = http_ratio
+        self.drop_ratio = drop_ratio
+        self.corrupt_ratio = corrupt_ratio
+        self.max_delay = max_delay
+        self.rate = rate
+        self.txid = self.random.randint(1, 1 << 30)
+        self.seq = 0
+        # heap of (due record number, txid) for responses still to be sent
+        self.pending = []
+
+    def flow(self, when):
+        r = self.random
+        self.seq += 1
+        return {
+            "@version": "1",
+            "@timestamp": "{0}.{1:03d}Z".format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(int(when))), int(when * 1000) % 1000),
+            "host": "10.1.1.2",
+            "type": "netflow",
+            "netflow": {
+                "version": 10,
+                "flow_seq_num": self.seq,
+                "flowset_id": 258,
+                "observationPointId": 1,
+                "exportingProcessId": 0,
+                "sourceIPv4Address": "10.{0}.{1}.{2}".format(r.randint(0, 3), r.randint(0, 255), r.randint(1, 254)),
+                "destinationIPv4Address": "192.168.{0}.{1}".format(r.randint(0, 3), r.randint(1, 254)),
+                "sourceTransportPort": r.randint(1024, 65535),
+                "destinationTransportPort": r.choice((80, 443)),
+                "protocolIdentifier": 6,
+                "ipVersion": 4,
+                "octetDeltaCount": r.randint(40, 150000),
+                "packetDeltaCount": r.randint(1, 120),
+                "flowStartMicroseconds": "{0}Z".format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(int(when)))),
+                "flowEndMicroseconds": "{0}Z".format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(int(when)))),
+                "netscalerRoundTripTime": r.randint(0, 200),
+                "netscalerConnectionId": r.randint(1, 1 << 30),
+                "netscalerFlowFlags": 84025344,
+                "netscalerAppNameAppId": 0,
+                "ingressInterface": 2147483651,
+                "egressInterface": 2147483651,
+            },
+        }
+
+    def request(self, when):
+        r = self.random
+        record = self.flow(when)
+        self.txid += 1
+        method = r.choice(METHODS)
+        if r.random() < self.corrupt_ratio:
+            method = r.choice(CORRUPT_METHODS)
+        host = r.choice(HOSTS)
+        record["netflow"].update({
+            "netscalerTransactionId": self.txid,
+            "netscalerHttpReqMethod": method,
+            "netscalerHttpReqUrl": "/{0}/{1}?id={2}".format(r.choice(("app", "api/v2", "static/img", "login")), r.randint(1, 100000), r.randint(1, 1 << 20)),
+            "netscalerHttpReqHost": host,
+            "netscalerHttpDomainName": host,
+            "netscalerHttpReqUserAgent": r.choice(AGENTS),
+            "netscalerHttpReqReferer": r.choice(("", "https://{0}/".format(host))),
+            "netscalerHttpReqCookie": "session={0:x}".format(r.getrandbits(64)),
+            "netscalerHttpReqXForwardedFor": "",
+        })
+        if method in METHODS and r.random() >= self.drop_ratio:
+            heapq.heappush(self.pending, (self.seq + r.randint(1, self.max_delay), self.txid))
+        return record
+
+    def response(self, when, txid):
+        record = self.flow(when)
+        record["netflow"].update({
+            "netscalerTransactionId": txid,
+            "netscalerHttpRspStatus": self.random.choice(STATUSES),
+            "netscalerHttpRspLen": self.random.randint(0, 500000),
+            "netscalerServerTTFB": self.random.randint(100, 90000),
+            "netscalerServerTTLB": self.random.randint(100, 900000),
+        })
+        return record
+
+    def records(self, count, start):
+        """Yield count records, starting at the epoch time start."""
+        for i in range(count):
+            when = start + float(i) / self.rate
+            if self.pending and self.pending[0][0] <= self.seq and self.random.random() < 0.5:
+                yield self.response(when, heapq.heappop(self.pending)[1])
+            elif self.random.random() < self.http_ratio:
+                yield self.request(when)
+            else:
+                yield self.flow(when)
+
+def generate(outdir, count, start, hours=1, **kwargs):
+    """Write count records spread over hours hourly files in outdir and
+    return their paths."""
+    per_hour = count // hours
+    gen = RecordGenerator(rate=max(per_hour / 3600.0, 0.001), **kwargs)
+    paths = []
+    for h in range(hours):
+        hstart = start + h * 3600
+        path = os.path.join(outdir, time.strftime('%Y-%m-%d.%H', time.gmtime(hstart)) + "_json.log")
+        with open(path, 'w') as f:
+            for record in gen.records(per_hour, hstart):
+                f.write(json.dumps(record) + "\n")
+        paths.append(path)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("outdir", help="Directory to write *_json.log files to")
+    parser.add_argument("-n", dest="count", default=100000, type=int, help="Total number of records")
+    parser.add_argument("--hours", dest="hours", default=1, type=int, help="Number of hourly files to spread records over")
+    parser.add_argument("--start", dest="start", default=1577872800, type=int, help="Epoch time of the first record")
+    parser.add_argument("--seed", dest="seed", default=1, type=int, help="Random seed")
+    parser.add_argument("--http-ratio", dest="http_ratio", default=0.4, type=float, help="Fraction of new records that are HTTP requests")
+    parser.add_argument("--drop-ratio", dest="drop_ratio", default=0.02, type=float, help="Fraction of requests that never get a response")
+    parser.add_argument("--corrupt-ratio", dest="corrupt_ratio", default=0.005, type=float, help="Fraction of requests with a corrupt method")
+    parser.add_argument("--max-delay", dest="max_delay", default=200, type=int, help="Maximum number of records between a request and its response")
+    p = parser.parse_args()
+
+    paths = generate(p.outdir, p.count, p.start, p.hours, seed=p.seed, http_ratio=p.http_ratio,
+                     drop_ratio=p.drop_ratio, corrupt_ratio=p.corrupt_ratio, max_delay=p.max_delay)
+    for path in paths:
+        print(path)
+
+if __name__ == "__main__":
+    main()
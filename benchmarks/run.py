@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""Measure throughput of the conversion paths on synthetic AppFlow data.
+
+Generates a reproducible data set with benchmarks.generate, then times:
+
+  ipfixout  ipfixout.main over each file (no correlation)
+  backlog   watch.process_file over each file, as at startup
+  live      the live pipeline fed by NetscalerParse.process_current, the
+            read behind each merged modify event, with the current hour's
+            file growing by --live-chunk records between reads
+
+Each run happens in a fresh process so peak RSS is per run. The correlating
+runs are repeated for every --max-state value, and report how many output
+lines were matched with a response and how many were written with the
+placeholder status of 0.
+
+Usage: python -m benchmarks.run [-n records] [--max-state 100,1000,10000]
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import resource
+import argparse
+import tempfile
+import datetime
+import multiprocessing
+
+import ipfixout
+from benchmarks import generate
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def count_lines(paths):
+    total = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            for line in f:
+                total += 1
+    return total
+
+def count_statuses(outdir):
+    matched = 0
+    placeholder = 0
+    for name in os.listdir(outdir):
+        if not name.endswith("-netscaler_http_apache.txt"):
+            continue
+        with open(os.path.join(outdir, name)) as f:
+            for line in f:
+                status = line.partition('HTTP/1.1" ')[2].split(" ", 1)[0]
+                if status == "0":
+                    placeholder += 1
+                else:
+                    matched += 1
+    return matched, placeholder
+
+def watch_args(watchdir, outdir, maxstate):
+    import watch
+    return watch.make_parser().parse_args([watchdir, "-o", outdir, "--max-state", str(maxstate),
+                                           "--position-file", os.path.join(outdir, "track.pos")])
+
+def run_ipfixout(paths, outdir, maxstate):
+    outfile = os.path.join(outdir, "ipfixout.txt")
+    errfile = os.path.join(outdir, "ipfixout.err")
+    start = time.time()
+    for path in paths:
+        sys.argv = ["ipfixout.py", path, "-o", outfile, "-e", errfile, "--with-dstip"]
+        ipfixout.main()
+    return time.time() - start
+
+def run_backlog(paths, outdir, maxstate):
+    import watch
+    args = watch_args(os.path.dirname(paths[0]), outdir, maxstate)
+    state = watch.new_state(args)
+    writer = watch.new_writer(args)
+    start = time.time()
+    for path in paths:
+        watch.process_file(path, 0, state, args, writer)
+    writer.close()
+    return time.time() - start
+
+def run_live(paths, outdir, maxstate, chunk):
+    import watch, checkpoint
+    watchdir = os.path.join(outdir, "watch")
+    os.mkdir(watchdir)
+    args = watch_args(watchdir, outdir, maxstate)
+    state = watch.new_state(args)
+    handler = watch.NetscalerParse(regexes=[r'.*\_json.log'], srcargs=args, state=state,
+                                   checkpoint=checkpoint.Checkpoint(outdir), posdata={"path": "", "position": 0})
+    handler.start()
+    start = time.time()
+    for path in paths:
+        livefile = os.path.join(watchdir, datetime.datetime.utcnow().strftime("%Y-%m-%d.%H") + "_json.log")
+        with open(path, 'rb') as src:
+            with open(livefile, 'ab') as dst:
+                done = False
+                while not done:
+                    for i in range(chunk):
+                        line = src.readline()
+                        if not line:
+                            done = True
+                            break
+                        dst.write(line)
+                    dst.flush()
+                    consumed, remaining = handler.process_current(args.batchbytes)
+                    while consumed and remaining:
+                        consumed, remaining = handler.process_current(args.maxbatchbytes)
+    # the later stages run alongside the appends, so time until the
+    # pipeline has drained and the output is closed rather than just the reads
+    handler.stop()
+    return time.time() - start
+
+def child(results, scenario, paths, outdir, maxstate, chunk):
+    if scenario == "ipfixout":
+        elapsed = run_ipfixout(paths, outdir, maxstate)
+    elif scenario == "backlog":
+        elapsed = run_backlog(paths, outdir, maxstate)
+    else:
+        elapsed = run_live(paths, outdir, maxstate, chunk)
+    results.put({"elapsed": elapsed, "rss": peak_rss_mb()})
+
+def measure(scenario, paths, records, maxstate, chunk):
+    outdir = tempfile.mkdtemp(prefix="ipfixbench")
+    try:
+        results = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=child, args=(results, scenario, paths, outdir, maxstate, chunk))
+        proc.start()
+        result = results.get()
+        proc.join()
+        matched, placeholder = count_statuses(outdir)
+    finally:
+        shutil.rmtree(outdir)
+    result.update({"scenario": scenario, "maxstate": maxstate, "records": records,
+                   "rate": records / result["elapsed"], "matched": matched, "placeholder": placeholder})
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="count", default=200000, type=int, help="Number of records to generate")
+    parser.add_argument("--hours", dest="hours", default=2, type=int, help="Number of hourly files to generate")
+    parser.add_argument("--seed", dest="seed", default=1, type=int, help="Random seed for the generated data")
+    parser.add_argument("--max-delay", dest="max_delay", default=2000, type=int, help="Maximum number of records between a request and its response")
+    parser.add_argument("--max-state", dest="maxstate", default="100,1000,10000", help="Comma separated --max-state values to run")
+    parser.add_argument("--scenarios", dest="scenarios", default="ipfixout,backlog,live", help="Comma separated scenarios to run")
+    parser.add_argument("--live-chunk", dest="chunk", default=500, type=int, help="Records appended between live modify events")
+    parser.add_argument("--data", dest="data", help="Directory of existing *_json.log files to use instead of generating")
+    parser.add_argument("--json", dest="json", action="store_true", help="Print results as JSON lines")
+    p = parser.parse_args()
+
+    datadir = p.data
+    if not datadir:
+        datadir = tempfile.mkdtemp(prefix="ipfixdata")
+        paths = generate.generate(datadir, p.count, 1577872800, p.hours, seed=p.seed, max_delay=p.max_delay)
+    else:
+        paths = sorted(os.path.join(datadir, f) for f in os.listdir(datadir) if f.endswith("_json.log"))
+    records = count_lines(paths)
+
+    try:
+        if not p.json:
+            print("{0:<10} {1:>9} {2:>9} {3:>8} {4:>11} {5:>9} {6:>9} {7:>11} {8:>7}".format(
+                "scenario", "max-state", "records", "secs", "records/s", "rss MB", "matched", "placeholder", "ph %"))
+        for scenario in p.scenarios.split(","):
+            maxstates = [int(m) for m in p.maxstate.split(",")]
+            if scenario == "ipfixout":
+                # no correlation, so the state size makes no difference
+                maxstates = maxstates[:1]
+            for maxstate in maxstates:
+                r = measure(scenario, paths, records, maxstate, p.chunk)
+                if p.json:
+                    print(json.dumps(r))
+                    continue
+                written = r["matched"] + r["placeholder"]
+                ratio = "-"
+                if scenario != "ipfixout" and written:
+                    ratio = "{0:.2f}".format(100.0 * r["placeholder"] / written)
+                print("{0:<10} {1:>9} {2:>9} {3:>8.2f} {4:>11.0f} {5:>9.1f} {6:>9} {7:>11} {8:>7}".format(
+                    scenario, "-" if scenario == "ipfixout" else maxstate, records, r["elapsed"], r["rate"], r["rss"],
+                    r["matched"] if scenario != "ipfixout" else "-", r["placeholder"] if scenario != "ipfixout" else "-", ratio))
+    finally:
+        if not p.data:
+            shutil.rmtree(datadir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+import os, json, logging
+import decode
+from transactions import Transaction
+
+logger = logging.getLogger(__name__)
+
+class Checkpoint(object):
+    """Input position and correlator state, saved together.
+
+    State is kept as a snapshot file plus an append-only journal. Every
+    commit() appends one line to the journal holding the position and the
+    changes to the state table since the previous commit, and fsyncs it, so
+    the two can never disagree after a crash. Once snapshot_every entries have
+    been journaled a fresh snapshot is written to a temporary file and renamed
+    into place, and the journal is truncated.
+
+    Both files hold one JSON document per line so they can be replayed a
+    line at a time. The snapshot header and each journal entry carry a
+    sequence number; journal entries already covered by the snapshot are
+    skipped on replay, and a torn entry at the end of the journal is dropped.
+    """
+    def __init__(self, path, snapshot_every=1000, name="ipfix"):
+        self.snapfile = os.path.join(path, name + ".snapshot")
+        self.journalfile = os.path.join(path, name + ".journal")
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self._entries = 0
+        self._journal = None
+
+    def load(self, state):
+        """Replay the snapshot and journal into state. Returns the saved
+        position as {"path": ..., "position": ...}, or None if there is no
+        checkpoint yet."""
+        posdata = None
+        if os.path.exists(self.snapfile):
+            with open(self.snapfile, 'rb') as f:
+                header = decode.loads(f.readline())
+                self.seq = header["seq"]
+                posdata = {"path": header["path"], "position": header["position"]}
+                for line in f:
+                    kind, record = decode.loads(line)
+                    state.restore(kind, Transaction.from_json(record))
+            logger.info("Loaded req[{0}] res[{1}] from snapshot".format(len(state.req), len(state.res)))
+
+        if os.path.exists(self.journalfile):
+            good = 0
+            replayed = 0
+            with open(self.journalfile, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entry = decode.loads(line)
+                    except ValueError:
+                        break
+                    good += len(line)
+                    if entry["seq"] <= self.seq:
+                        continue
+                    for kind, txid in entry["del"]:
+                        state.discard(kind, txid)
+                    for kind, record in entry["add"]:
+                        state.restore(kind, Transaction.from_json(record))
+                    self.seq = entry["seq"]
+                    posdata = {"path": entry["path"], "position": entry["position"]}
+                    replayed += 1
+            if os.path.getsize(self.journalfile) != good:
+                logger.info("Dropping incomplete entry at the end of {0}".format(self.journalfile))
+                with open(self.journalfile, 'r+b') as f:
+                    f.truncate(good)
+            self._entries = replayed
+            logger.info("Replayed {0} journal entries: req[{1}] res[{2}]".format(replayed, len(state.req), len(state.res)))
+
+        # everything loaded is already on disk
+        state.take_delta()
+        return posdata
+
+    def commit(self, posdata, state):
+        self.apply(self.prepare(posdata, state))
+
+    def schedule(self):
+        """Count one checkpoint and return True if it should be a snapshot.
+        prepare() does this itself unless told the answer, which lets a
+        caller that has to gather the full state ahead of time decide early."""
+        self._entries += 1
+        if self._entries >= self.snapshot_every:
+            self._entries = 0
+            return True
+        return False
+
+    def prepare(self, posdata, state, snapshot=None):
+        """Capture the changes to state since the last call, for a later
+        apply(). This lets the thread that owns the state record it at a
+        position while another makes it durable once the output up to that
+        position has been flushed. Prepared checkpoints must be applied in
+        order."""
+        added, removed = state.take_delta()
+        self.seq += 1
+        if snapshot is None:
+            snapshot = self.schedule()
+        if snapshot:
+            # the snapshot covers this entry, so it need not be journaled
+            lines, sizes = self.snapshot_lines(self.seq, posdata, state)
+            return ("snapshot", lines, sizes)
+        entry = {"seq": self.seq, "path": posdata["path"], "position": posdata["position"],
+                 "del": removed, "add": [(kind, t.as_json()) for kind, t in added]}
+        return ("journal", (json.dumps(entry) + "\n").encode("utf-8"), None)
+
+    def apply(self, prepared):
+        kind, data, sizes = prepared
+        if kind == "snapshot":
+            self.write_snapshot(data, sizes)
+            return
+        if self._journal is None:
+            self._journal = open(self.journalfile, 'ab')
+        self._journal.write(data)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def snapshot(self, posdata, state):
+        # the snapshot covers any changes not yet journaled
+        state.take_delta()
+        self._entries = 0
+        self.write_snapshot(*self.snapshot_lines(self.seq, posdata, state))
+
+    def snapshot_lines(self, seq, posdata, state):
+        """Return the lines of a snapshot and the number of requests and
+        responses in it."""
+        header = {"seq": seq, "path": posdata["path"], "position": posdata["position"]}
+        lines = [(json.dumps(header) + "\n").encode("utf-8")]
+        sizes = []
+        for kind in ("req", "res"):
+            start = len(lines)
+            for t in state.pending(kind):
+                lines.append((json.dumps((kind, t.as_json())) + "\n").encode("utf-8"))
+            sizes.append(len(lines) - start)
+        return lines, sizes
+
+    def write_snapshot(self, lines, sizes):
+        tmpfile = self.snapfile + ".tmp"
+        with open(tmpfile, 'wb') as f:
+            f.write(b"".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpfile, self.snapfile)
+        dirfd = os.open(os.path.dirname(self.snapfile) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journalfile, 'wb')
+        logger.info("State: req[{0}], res[{1}] written to {2}".format(sizes[0], sizes[1], self.snapfile))
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
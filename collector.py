@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+"""Collect Netscaler AppFlow over IPFIX directly, without Logstash.
+
+listen  decode IPFIX messages arriving on a UDP port, correlate HTTP requests
+        and responses and write the same hourly output files as watch.py
+replay  send Logstash *_json.log records to a collector as IPFIX, for testing
+"""
+import sys, os, time, socket, struct, signal, logging, argparse, traceback
+import formats, transactions, writers, checkpoint, metrics, spill, archive
+
+logger = logging.getLogger(__name__)
+
+NETSCALER_PEN = 5951
+VARLEN = 65535
+
+# (enterprise number, element id) -> (name, type, length used when sending);
+# names match those used by the Logstash netflow codec
+ELEMENTS = {
+    (0, 1): ("octetDeltaCount", "unsigned", 8),
+    (0, 2): ("packetDeltaCount", "unsigned", 8),
+    (0, 4): ("protocolIdentifier", "unsigned", 1),
+    (0, 7): ("sourceTransportPort", "unsigned", 2),
+    (0, 8): ("sourceIPv4Address", "ipv4", 4),
+    (0, 10): ("ingressInterface", "unsigned", 4),
+    (0, 11): ("destinationTransportPort", "unsigned", 2),
+    (0, 12): ("destinationIPv4Address", "ipv4", 4),
+    (0, 14): ("egressInterface", "unsigned", 4),
+    (0, 60): ("ipVersion", "unsigned", 1),
+    (0, 138): ("observationPointId", "unsigned", 4),
+    (0, 144): ("exportingProcessId", "unsigned", 4),
+    (NETSCALER_PEN, 128): ("netscalerRoundTripTime", "unsigned", 4),
+    (NETSCALER_PEN, 129): ("netscalerTransactionId", "unsigned", 4),
+    (NETSCALER_PEN, 130): ("netscalerHttpReqUrl", "string", VARLEN),
+    (NETSCALER_PEN, 131): ("netscalerHttpReqCookie", "string", VARLEN),
+    (NETSCALER_PEN, 132): ("netscalerFlowFlags", "unsigned", 8),
+    (NETSCALER_PEN, 133): ("netscalerConnectionId", "unsigned", 4),
+    (NETSCALER_PEN, 140): ("netscalerHttpReqReferer", "string", VARLEN),
+    (NETSCALER_PEN, 141): ("netscalerHttpReqMethod", "string", VARLEN),
+    (NETSCALER_PEN, 142): ("netscalerHttpReqHost", "string", VARLEN),
+    (NETSCALER_PEN, 143): ("netscalerHttpReqUserAgent", "string", VARLEN),
+    (NETSCALER_PEN, 144): ("netscalerHttpRspStatus", "unsigned", 2),
+    (NETSCALER_PEN, 145): ("netscalerHttpRspLen", "unsigned", 8),
+    (NETSCALER_PEN, 146): ("netscalerServerTTFB", "unsigned", 8),
+    (NETSCALER_PEN, 147): ("netscalerServerTTLB", "unsigned", 8),
+    (NETSCALER_PEN, 151): ("netscalerAppNameAppId", "unsigned", 4),
+    (NETSCALER_PEN, 200): ("netscalerHttpDomainName", "string", VARLEN),
+}
+NAMES = dict((name, (key, kind, length)) for key, (name, kind, length) in ELEMENTS.items())
+
+# data records from templates with neither field are not decoded at all
+HTTP_FIELDS = frozenset(("netscalerHttpReqMethod", "netscalerHttpRspStatus"))
+
+UNPACK = {1: ">B", 2: ">H", 4: ">I", 8: ">Q"}
+
+PACKETS = metrics.Counter("ipfixcollector_packets_total", "IPFIX messages received")
+RECORDS = metrics.Counter("ipfixcollector_records_total", "HTTP data records decoded")
+SKIPPED = metrics.Counter("ipfixcollector_skipped_sets_total", "Data sets skipped as non-HTTP or with no known template")
+ERRORS = metrics.Counter("ipfixcollector_errors_total", "Messages or records that could not be processed")
+ROWS_WRITTEN = metrics.Counter("ipfixcollector_rows_written_total", "Output lines written")
+
+def decode_unsigned(data, offset, length):
+    if length in UNPACK:
+        return struct.unpack_from(UNPACK[length], data, offset)[0]
+    value = 0
+    for b in bytearray(data[offset:offset + length]):
+        value = value << 8 | b
+    return value
+
+def decode_ipv4(data, offset, length):
+    return socket.inet_ntoa(data[offset:offset + 4])
+
+def decode_string(data, offset, length):
+    return data[offset:offset + length].decode("utf-8", "replace").rstrip(u"\x00")
+
+DECODERS = {"unsigned": decode_unsigned, "ipv4": decode_ipv4, "string": decode_string}
+
+class Template(object):
+    __slots__ = ("fields", "http", "minlen")
+
+    def __init__(self, fields):
+        # list of ((name, decoder) or None, length)
+        self.fields = fields
+        self.http = any(element is not None and element[0] in HTTP_FIELDS for element, length in fields)
+        self.minlen = sum(1 if length == VARLEN else length for element, length in fields)
+
+class IPFIXDecoder(object):
+    """Decode IPFIX messages (RFC 7011) into dicts of named fields.
+
+    Templates are remembered per exporter address and observation domain.
+    Only elements listed in ELEMENTS are decoded; others are skipped by
+    length.
+    """
+    def __init__(self):
+        self.templates = {}
+
+    def decode(self, data, source):
+        """Yield (export time, fields) for each HTTP data record in a message."""
+        if len(data) < 16:
+            raise ValueError("Short IPFIX message from {0}".format(source))
+        version, length, export_time, seq, domain = struct.unpack_from(">HHIII", data, 0)
+        if version != 10:
+            raise ValueError("Unsupported version {0} from {1}".format(version, source))
+        end = min(length, len(data))
+        offset = 16
+        while offset + 4 <= end:
+            setid, setlen = struct.unpack_from(">HH", data, offset)
+            if setlen < 4 or offset + setlen > end:
+                raise ValueError("Bad set length {0} from {1}".format(setlen, source))
+            if setid == 2:
+                self.add_templates(data, offset + 4, offset + setlen, (source, domain))
+            elif setid >= 256:
+                template = self.templates.get((source, domain, setid))
+                if template is None or not template.http:
+                    SKIPPED.inc()
+                else:
+                    for fields in self.decode_records(template, data, offset + 4, offset + setlen):
+                        yield export_time, fields
+            # options templates (set 3) are not needed, so their data sets
+            # are skipped as unknown
+            offset += setlen
+
+    def add_templates(self, data, offset, end, exporter):
+        while offset + 4 <= end:
+            tid, count = struct.unpack_from(">HH", data, offset)
+            offset += 4
+            if count == 0:
+                # template withdrawal
+                self.templates.pop(exporter + (tid,), None)
+                continue
+            fields = []
+            for i in range(count):
+                ie, length = struct.unpack_from(">HH", data, offset)
+                offset += 4
+                pen = 0
+                if ie & 0x8000:
+                    ie &= 0x7fff
+                    pen = struct.unpack_from(">I", data, offset)[0]
+                    offset += 4
+                element = ELEMENTS.get((pen, ie))
+                if element is not None:
+                    element = (element[0], DECODERS[element[1]])
+                fields.append((element, length))
+            self.templates[exporter + (tid,)] = Template(fields)
+            logger.debug("Template {0} from {1} with {2} fields".format(tid, exporter, count))
+
+    def decode_records(self, template, data, offset, end):
+        # anything shorter than the smallest possible record is set padding
+        while template.minlen and end - offset >= template.minlen:
+            fields = {}
+            for element, length in template.fields:
+                if length == VARLEN:
+                    length = struct.unpack_from(">B", data, offset)[0]
+                    offset += 1
+                    if length == 255:
+                        length = struct.unpack_from(">H", data, offset)[0]
+                        offset += 2
+                if offset + length > end:
+                    raise ValueError("Record overruns its set")
+                if element is not None:
+                    fields[element[0]] = element[1](data, offset, length)
+                offset += length
+            yield fields
+
+class Collector(object):
+    """Correlate HTTP records from IPFIX messages and write them out hourly."""
+    def __init__(self, args):
+        self.args = args
+        self.decoder = IPFIXDecoder()
+        self.state = transactions.TransactionTable(args.maxstate, args.maxstate * 5, args.statettl, spill.open_store(args, "collector"))
+        self.formatter = formats.formatter(args.format, args.fields)
+        self.writer = writers.HourlyWriter(args.flushlines, args.flushms, args.fsync, binary=self.formatter.binary)
+        self.archive = archive.Archive(args.archive) if args.archive else None
+        self.checkpoint = checkpoint.Checkpoint(args.outpath, args.snapshotevery, "collector")
+        self.checkpoint.load(self.state)
+        self.packets = 0
+        self.exit_now = False
+        self._last_checkpoint = time.time()
+        self._timestamp = (None, None)
+
+    def timestamp(self, export_time):
+        if self._timestamp[0] != export_time:
+            t = time.gmtime(export_time)
+            self._timestamp = (export_time, (time.strftime('%Y-%m-%dT%H:%M:%S.000Z', t),
+                               os.path.join(self.args.outpath, time.strftime('%Y-%m-%d.%H', t) + "-netscaler_http" + self.formatter.suffix)))
+        return self._timestamp[1]
+
+    def handle(self, data, source):
+        self.packets += 1
+        PACKETS.inc()
+        try:
+            for export_time, fields in self.decoder.decode(data, source):
+                RECORDS.inc()
+                timestamp, outname = self.timestamp(export_time)
+                try:
+                    completed = self.state.feed({"@timestamp": timestamp, "netflow": fields})
+                    for outline in completed:
+                        self.writer.write(outname, self.formatter.format(outline) + self.formatter.newline)
+                        ROWS_WRITTEN.inc()
+                    if completed and self.archive is not None:
+                        self.archive.add(list(map(archive.row, completed)))
+                except Exception as e:
+                    ERRORS.inc()
+                    logger.debug("Failed to process record {0}: {1}".format(fields, e))
+        except Exception as e:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
+            ERRORS.inc()
+
+    def save(self):
+        self.writer.checkpoint()
+        if self.archive is not None:
+            self.archive.age()
+        self.checkpoint.commit({"path": self.args.listen, "position": self.packets}, self.state)
+        self._last_checkpoint = time.time()
+
+    def run(self, sock):
+        sock.settimeout(self.args.checkpointms / 1000.0)
+        while not self.exit_now:
+            try:
+                data, source = sock.recvfrom(65535)
+                self.handle(data, source[0])
+            except socket.timeout:
+                pass
+            if time.time() - self._last_checkpoint >= self.args.checkpointms / 1000.0:
+                self.save()
+
+    def close(self):
+        self.writer.close()
+        if self.archive is not None:
+            self.archive.close()
+        self.checkpoint.snapshot({"path": self.args.listen, "position": self.packets}, self.state)
+        self.checkpoint.close()
+        self.state.close()
+
+    def breakout(self, signum, frame):
+        self.exit_now = True
+
+def encode_value(kind, length, value):
+    if kind == "ipv4":
+        return socket.inet_aton(value)
+    if kind == "string":
+        if not isinstance(value, bytes):
+            value = value.encode("utf-8")
+        if len(value) < 255:
+            return struct.pack(">B", len(value)) + value
+        return struct.pack(">BH", 255, len(value)) + value
+    if length in UNPACK:
+        return struct.pack(UNPACK[length], int(value))
+    return bytes(bytearray((int(value) >> (8 * i)) & 0xff for i in reversed(range(length))))
+
+def encode_messages(records, domain=1, mtu=1400):
+    """Encode Logstash JSON records as IPFIX messages, yielding each message.
+
+    Each distinct set of fields gets its own template, sent in every message
+    that uses it. Records keep their order: a new data set is started whenever
+    the template changes, and a new message whenever the export second does.
+    """
+    templates = {}
+    seq = 0
+    pending = []
+    size = 0
+    export_time = None
+    for record in records:
+        netflow = record["netflow"]
+        when = transactions.timestamp_epoch(record["@timestamp"])
+        names = tuple(sorted(name for name in netflow if name in NAMES))
+        if not names:
+            continue
+        if names not in templates:
+            templates[names] = 256 + len(templates)
+        try:
+            body = b"".join(encode_value(NAMES[n][1], NAMES[n][2], netflow[n]) for n in names)
+        except (ValueError, TypeError, socket.error):
+            continue
+        if pending and (when != export_time or size + len(body) > mtu):
+            yield build_message(pending, templates, export_time, seq, domain)
+            seq += len(pending)
+            pending = []
+            size = 0
+        export_time = when
+        pending.append((names, body))
+        size += len(body)
+    if pending:
+        yield build_message(pending, templates, export_time, seq, domain)
+
+def build_message(pending, templates, export_time, seq, domain):
+    sets = []
+    used = []
+    for names, body in pending:
+        if names not in used:
+            used.append(names)
+    tbody = b""
+    for names in used:
+        tbody += struct.pack(">HH", templates[names], len(names))
+        for name in names:
+            (pen, ie), kind, length = NAMES[name]
+            if pen:
+                tbody += struct.pack(">HHI", ie | 0x8000, length, pen)
+            else:
+                tbody += struct.pack(">HH", ie, length)
+    sets.append(struct.pack(">HH", 2, len(tbody) + 4) + tbody)
+    run = []
+    current = None
+    for names, body in pending + [(None, b"")]:
+        if names != current and run:
+            data = b"".join(run)
+            sets.append(struct.pack(">HH", templates[current], len(data) + 4) + data)
+            run = []
+        current = names
+        run.append(body)
+    payload = b"".join(sets)
+    return struct.pack(">HHIII", 10, len(payload) + 16, export_time, seq, domain) + payload
+
+def replay(p):
+    import decode
+    host, port = p.to.rsplit(":", 1)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    target = (host, int(port))
+    sent = 0
+
+    def records():
+        for path in p.sourcefiles:
+            with open(path, 'rb') as f:
+                for line in f:
+                    yield decode.loads(line)
+
+    for message in encode_messages(records(), p.domain):
+        sock.sendto(message, target)
+        sent += 1
+        if p.pps:
+            time.sleep(1.0 / p.pps)
+    logger.info("Sent {0} messages to {1}".format(sent, p.to))
+
+def listen(p):
+    host, port = p.listen.rsplit(":", 1)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, p.rcvbuf)
+    sock.bind((host, int(port)))
+    collector = Collector(p)
+    signal.signal(signal.SIGTERM, collector.breakout)
+    signal.signal(signal.SIGINT, collector.breakout)
+    if p.metricsport:
+        metrics.serve(p.metricshost, p.metricsport)
+    logger.info("Listening for IPFIX on {0}".format(p.listen))
+    try:
+        collector.run(sock)
+    finally:
+        logger.info("Received {0} messages, shutting down".format(collector.packets))
+        collector.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command")
+
+    lp = sub.add_parser("listen", help="Collect IPFIX from Netscaler appliances")
+    lp.add_argument("--listen", dest="listen", default="0.0.0.0:4739", help="Address and UDP port to listen on")
+    lp.add_argument("-o", dest="outpath", default="/var/log/apache/")
+    lp.add_argument("-f", "--format", dest="format", default="apache", choices=sorted(formats.FORMATS), help="Output format")
+    lp.add_argument("--fields", dest="fields", help="Comma separated fields to output, for formats other than apache")
+    lp.add_argument("--archive", dest="archive", help="Also write every output row to an hourly indexed archive in this directory, \
+for lookups with archive.py query")
+    lp.add_argument("--max-state", dest="maxstate", default=1000, type=int, help="Maximum HTTP request records to hold in memory before flushing out. \
+Records with no matching response will have placeholder values in the output.")
+    lp.add_argument("--state-ttl", dest="statettl", default=0, type=int, help="Write out pending HTTP requests with placeholder values once they are (n) seconds \
+older than the newest record seen. Disabled by default.")
+    lp.add_argument("--spill", dest="spill", action="store_true", help="Move requests and responses over --max-state to an on-disk store \
+in the output directory, where they can still be matched, instead of writing them out with placeholder values")
+    lp.add_argument("--spill-ttl", dest="spillttl", default=600, type=int, help="Write out spilled requests with placeholder values once they \
+are (n) seconds older than the newest record seen, 0 to disable")
+    lp.add_argument("--spill-max", dest="spillmax", default=10000000, type=int, help="Write out the oldest spilled requests once more than (n) \
+requests and responses are spilled, 0 for no limit")
+    lp.add_argument("--checkpoint-ms", dest="checkpointms", default=1000, type=int, help="Save state and flush output every (n) milliseconds")
+    lp.add_argument("--snapshot-every", dest="snapshotevery", default=1000, type=int, help="Compact the state journal into a snapshot after (n) checkpoints")
+    lp.add_argument("--flush-lines", dest="flushlines", default=1000, type=int, help="Flush output after (n) buffered lines, 0 to disable")
+    lp.add_argument("--flush-ms", dest="flushms", default=1000, type=int, help="Flush output (n) milliseconds after the last flush, 0 to disable")
+    lp.add_argument("--fsync", dest="fsync", default="checkpoint", choices=writers.FSYNC_POLICIES, help="When to fsync output files")
+    lp.add_argument("--rcvbuf", dest="rcvbuf", default=8388608, type=int, help="UDP receive buffer size in bytes")
+    lp.add_argument("--metrics-port", dest="metricsport", default=0, type=int, help="Serve Prometheus metrics on this port, 0 to disable")
+    lp.add_argument("--metrics-host", dest="metricshost", default="127.0.0.1", help="Address to serve metrics on")
+
+    rp = sub.add_parser("replay", help="Send Logstash JSON records to a collector as IPFIX")
+    rp.add_argument("sourcefiles", nargs="+", help="Logstash *_json.log files")
+    rp.add_argument("--to", dest="to", default="127.0.0.1:4739", help="Collector address and UDP port")
+    rp.add_argument("--domain", dest="domain", default=1, type=int, help="Observation domain ID to send")
+    rp.add_argument("--pps", dest="pps", default=0, type=int, help="Limit to (n) messages per second, 0 for no limit")
+
+    for p in (lp, rp):
+        p.add_argument("-l", dest="loglevel", default="INFO")
+
+    p = parser.parse_args()
+
+    lvl = getattr(logging, p.loglevel)
+    ch = logging.StreamHandler()
+    ch.setLevel(lvl)
+    ch.setFormatter(logging.Formatter('%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    for name in (__name__, "checkpoint", "writers", "metrics"):
+        logging.getLogger(name).setLevel(lvl)
+        logging.getLogger(name).addHandler(ch)
+
+    if p.command == "listen":
+        try:
+            formats.formatter(p.format, p.fields)
+        except ValueError as e:
+            lp.error(str(e))
+        listen(p)
+    elif p.command == "replay":
+        replay(p)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
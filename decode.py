@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+import json
+
+# use a faster JSON parser if one is installed
+try:
+    import orjson
+    loads = orjson.loads
+    backend = "orjson"
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+        backend = "ujson"
+    except ImportError:
+        loads = json.loads
+        backend = "json"
+
+HTTP_KEYS = ("netscalerHttpReqMethod", "netscalerHttpRspStatus")
+
+class Decoder(object):
+    """Decode raw Logstash JSON lines, skipping any that cannot be HTTP records.
+
+    Lines are scanned for the quoted key names first; a line which contains
+    none of them is rejected without being parsed. Lines should be bytes
+    (str on Python 2).
+    """
+    def __init__(self, keys=HTTP_KEYS):
+        self.markers = tuple(('"{0}"'.format(k)).encode("ascii") for k in keys)
+        self.rejected = 0
+        self.decoded = 0
+
+    def decode(self, line):
+        for marker in self.markers:
+            if marker in line:
+                break
+        else:
+            self.rejected += 1
+            return None
+        line_json = loads(line)
+        self.decoded += 1
+        return line_json
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""Output formats for correlated HTTP transactions.
+
+Each formatter is compiled once from its list of field names, so formatting a
+record is one extraction of the field values into a tuple followed by one
+join, format or pack. Records can be transactions.Transaction objects
+(format) or decoded Logstash records (format_json).
+
+  apache  the custom Apache combined format the tool has always written
+  json    one JSON object per line, keyed by field name
+  csv     comma separated, quoted where needed
+  tsv     tab separated, with tabs and line breaks in values replaced by spaces
+  binary  fixed-width little-endian records, see BinaryFormatter
+"""
+import os, json, time, struct, socket, operator
+import transactions
+
+try:
+    STRING_TYPES = (str, unicode)
+except NameError:
+    STRING_TYPES = (str,)
+
+# field name -> (Transaction attribute, Logstash netflow key, kind)
+FIELDS = {
+    "timestamp": ("timestamp", "@timestamp", "time"),
+    "srcip": ("srcip", "sourceIPv4Address", "ipv4"),
+    "dstip": ("dstip", "destinationIPv4Address", "ipv4"),
+    "txid": ("txid", "netscalerTransactionId", "uint32"),
+    "method": ("method", "netscalerHttpReqMethod", "text"),
+    "url": ("url", "netscalerHttpReqUrl", "text"),
+    "referer": ("referer", "netscalerHttpReqReferer", "text"),
+    "useragent": ("useragent", "netscalerHttpReqUserAgent", "text"),
+    "host": ("host", "netscalerHttpDomainName", "text"),
+    "status": ("status", "netscalerHttpRspStatus", "uint16"),
+    "size": ("size", "netscalerHttpRspLen", "uint64"),
+}
+DEFAULT_FIELDS = ("timestamp", "srcip", "dstip", "method", "url", "status", "size", "referer", "useragent", "host")
+
+DATE_CACHE_SIZE = 4096
+_date_cache = {}
+
+def convert_date(indate):
+    d = time.strptime(indate, '%Y-%m-%dT%H:%M:%S.%fZ')
+    return time.strftime('%d/%b/%Y:%H:%M:%S +0000', d)
+
+def reformat_date(indate):
+    # output only has one second resolution, so cache on everything up to
+    # the fractional part of the timestamp
+    key = indate[:19]
+    try:
+        return _date_cache[key]
+    except KeyError:
+        pass
+    datestr = convert_date(indate)
+    if len(_date_cache) >= DATE_CACHE_SIZE:
+        _date_cache.clear()
+    _date_cache[key] = datestr
+    return datestr
+
+class Formatter(object):
+    name = None
+    suffix = ".txt"
+    binary = False
+
+    def __init__(self, fields=DEFAULT_FIELDS):
+        for field in fields:
+            if field not in FIELDS:
+                raise ValueError("Unknown output field {0}".format(field))
+        self.fields = tuple(fields)
+        attrs = [FIELDS[field][0] for field in self.fields]
+        if len(attrs) == 1:
+            self._values = lambda t: (getattr(t, attrs[0]),)
+        else:
+            self._values = operator.attrgetter(*attrs)
+        self._keys = [FIELDS[field][1] for field in self.fields]
+        self._defaults = (None,) * len(self.fields)
+        self._time = self.fields.index("timestamp") if "timestamp" in self.fields else None
+        self.newline = b"" if self.binary else os.linesep
+
+    def format(self, t):
+        return self.render(list(self._values(t)))
+
+    def format_json(self, line_json):
+        values = list(map(line_json["netflow"].get, self._keys, self._defaults))
+        if self._time is not None:
+            values[self._time] = line_json["@timestamp"]
+        return self.render(values)
+
+    def render(self, values):
+        """Return the output for a list of field values, which may be modified."""
+        raise NotImplementedError
+
+class ApacheFormatter(Formatter):
+    """srcip - - [date] "method url HTTP/1.1" status size "referer" "useragent" host [dstip]
+
+    The field list is fixed. Missing values are written as -, except srcip
+    (empty) and status (418); dstip is only appended when present.
+    """
+    name = "apache"
+    suffix = "_apache.txt"
+    APACHE_FIELDS = ("srcip", "timestamp", "method", "url", "status", "size", "referer", "useragent", "host", "dstip")
+    DEFAULTS = ("", "", "-", "-", "418", "-", "-", "-", "-", None)
+    TEMPLATE = '%s - - [%s] "%s %s HTTP/1.1" %s %s "%s" "%s" %s'
+
+    def __init__(self, fields=None, with_dstip=True):
+        count = 10 if with_dstip else 9
+        super(ApacheFormatter, self).__init__(self.APACHE_FIELDS[:count])
+        self._defaults = self.DEFAULTS[:count]
+        self._dstip = self.TEMPLATE + " %s" if with_dstip else self.TEMPLATE
+
+    def render(self, values):
+        if None in values:
+            values = [d if v is None else v for v, d in zip(values, self._defaults)]
+        values[1] = reformat_date(values[1])
+        if values[-1] is None:
+            values.pop()
+            return self.TEMPLATE % tuple(values)
+        return self._dstip % tuple(values)
+
+def csv_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, STRING_TYPES):
+        if '"' in value or "," in value or "\n" in value or "\r" in value:
+            return '"' + value.replace('"', '""') + '"'
+        return value
+    return str(value)
+
+def tsv_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, STRING_TYPES):
+        if "\t" in value or "\n" in value or "\r" in value:
+            return value.replace("\t", " ").replace("\n", " ").replace("\r", " ")
+        return value
+    return str(value)
+
+class CSVFormatter(Formatter):
+    name = "csv"
+    suffix = ".csv"
+    separator = ","
+    cell = staticmethod(csv_cell)
+
+    def render(self, values):
+        cell = self.cell
+        return self.separator.join([cell(v) for v in values])
+
+class TSVFormatter(CSVFormatter):
+    name = "tsv"
+    suffix = ".tsv"
+    separator = "\t"
+    cell = staticmethod(tsv_cell)
+
+class JSONFormatter(Formatter):
+    name = "json"
+    suffix = ".json"
+
+    def __init__(self, fields=DEFAULT_FIELDS):
+        super(JSONFormatter, self).__init__(fields)
+        self._encode = json.JSONEncoder(separators=(",", ":")).encode
+
+    def render(self, values):
+        return self._encode(dict(zip(self.fields, values)))
+
+# width of each text field in binary records; longer values are truncated
+TEXT_WIDTHS = {"method": 8, "url": 256, "referer": 128, "useragent": 128, "host": 64}
+
+def pack_time(value):
+    return transactions.timestamp_epoch(value) if value else 0
+
+def pack_ipv4(value):
+    return socket.inet_aton(value) if value else b"\0\0\0\0"
+
+def pack_int(value):
+    return int(value) if value is not None else 0
+
+def pack_text(value):
+    return value.encode("utf-8") if value is not None else b""
+
+PACKERS = {
+    "time": ("I", pack_time),
+    "ipv4": ("4s", pack_ipv4),
+    "uint16": ("H", pack_int),
+    "uint32": ("I", pack_int),
+    "uint64": ("Q", pack_int),
+}
+
+class BinaryFormatter(Formatter):
+    """Fixed-width little-endian records with no separators.
+
+    Times are epoch seconds (uint32), addresses 4 bytes, numbers unsigned
+    integers of their IPFIX width and text fields NUL padded UTF-8 of the
+    width in TEXT_WIDTHS. Missing values are zero. As every record has the
+    same size, each column can be read from a file by stride, for example
+    with numpy.fromfile and a dtype built from layout().
+    """
+    name = "binary"
+    suffix = ".bin"
+    binary = True
+
+    def __init__(self, fields=DEFAULT_FIELDS):
+        super(BinaryFormatter, self).__init__(fields)
+        codes = []
+        self._packers = []
+        for field in self.fields:
+            kind = FIELDS[field][2]
+            if kind == "text":
+                codes.append("{0}s".format(TEXT_WIDTHS[field]))
+                self._packers.append(pack_text)
+            else:
+                codes.append(PACKERS[kind][0])
+                self._packers.append(PACKERS[kind][1])
+        self._codes = codes
+        self._struct = struct.Struct("<" + "".join(codes))
+        self.size = self._struct.size
+
+    def layout(self):
+        """Return (field, struct code) pairs describing a record."""
+        return list(zip(self.fields, self._codes))
+
+    def render(self, values):
+        return self._struct.pack(*[pack(v) for pack, v in zip(self._packers, values)])
+
+FORMATS = dict((cls.name, cls) for cls in (ApacheFormatter, JSONFormatter, CSVFormatter, TSVFormatter, BinaryFormatter))
+
+_compiled = {}
+
+def formatter(name, fields=None, with_dstip=True):
+    """Return the formatter for a format name and comma separated field list,
+    compiling it on first use. Without a field list DEFAULT_FIELDS are used,
+    less dstip unless with_dstip is set. The apache format takes no field
+    list."""
+    key = (name, fields, with_dstip)
+    try:
+        return _compiled[key]
+    except KeyError:
+        pass
+    if name not in FORMATS:
+        raise ValueError("Unknown output format {0}".format(name))
+    if name == "apache":
+        if fields:
+            raise ValueError("The apache format has fixed fields, --fields only applies to the other formats")
+        formatter = ApacheFormatter(with_dstip=with_dstip)
+    else:
+        if fields:
+            names = tuple(f.strip() for f in fields.split(","))
+        else:
+            names = tuple(f for f in DEFAULT_FIELDS if with_dstip or f != "dstip")
+        formatter = FORMATS[name](names)
+    _compiled[key] = formatter
+    return formatter
@@ -1,50 +1,24 @@
 #!/usr/bin/env python
+import os
+import io
 import sys
+import gzip
+import glob
 import json
 import time
+import shutil
 import argparse
+import tempfile
+import traceback
+import multiprocessing
+import decode
+import formats
 
-def reformat_date(indate):
-    d = time.strptime(indate, '%Y-%m-%dT%H:%M:%S.%fZ')
-    return time.strftime('%d/%b/%Y:%H:%M:%S +0000', d)
-
-def format_log_line(line_json, args):
-    datestr = reformat_date(line_json["@timestamp"])
-    srcip = ""
-    if "sourceIPv4Address" in line_json["netflow"]:
-        srcip = line_json["netflow"]["sourceIPv4Address"]
-    httpver = "HTTP/1.1" # bit of a fudge tbh
-    httpstatcode = "418" # Honest, guv.
-    size = "-" # I give up now
-    if "netscalerHttpRspStatus" in line_json["netflow"]:
-        # well, maybe
-        httpstatcode = line_json["netflow"]["netscalerHttpRspStatus"]
-    if "netscalerHttpRspLen" in line_json["netflow"]:    
-        size = line_json["netflow"]["netscalerHttpRspLen"]
-        
-    httpuri = "-"
-    httpcmd = "-"
-    httpreferer = "-"
-    httpuseragent = "-"
-    dsthost = "-"
-
-    # override blank values if item present
-    httpuri = line_json["netflow"]["netscalerHttpReqUrl"]
-    httpcmd = line_json["netflow"]["netscalerHttpReqMethod"]
-    httpreferer = line_json["netflow"]["netscalerHttpReqReferer"]
-    httpuseragent = line_json["netflow"]["netscalerHttpReqUserAgent"]
-    dsthost = line_json["netflow"]["netscalerHttpDomainName"]
-
-    line = '{0} - - [{1}] "{2} {3} {4}" {5} {6} "{7}" "{8}" {9}'.format(
-        srcip, datestr, httpcmd, httpuri, httpver, httpstatcode, size, httpreferer, httpuseragent, dsthost)
-
-    if "destinationIPv4Address" in line_json["netflow"] and args.with_dstip:
-        line += " {0}".format(line_json["netflow"]["destinationIPv4Address"])
-
-    return line
-
-def write_to_log_file(line, outfile):
-    outfile.write(line)
+# zstd compressed input is optional
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 def write_error(error_string, args):
     t = time.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
@@ -57,6 +31,16 @@ def write_error(error_string, args):
 def file_process_errors(input_file, error_json):
     return "Errors encountered processing input file {0}: {1}\n".format(input_file, json.dumps(error_json))
 
+# the line formatting now lives in formats.py; these are kept for callers
+# of the functions ipfixout.py used to provide
+reformat_date = formats.reformat_date
+
+def format_log_line(line_json, args):
+    return formats.formatter("apache", None, args.with_dstip).format_json(line_json)
+
+def write_to_log_file(line, outfile):
+    outfile.write(line)
+
 def output_line(line_json, args):
     formatted_line = format_log_line(line_json, args)
     if args.destfile:
@@ -64,47 +48,189 @@ def output_line(line_json, args):
     else:
         print(formatted_line)
 
+# lines are written out in batches of this many, through a buffer of this size
+WRITE_LINES = 10000
+WRITE_BUFFER = 4194304
+
+def new_counters():
+    return {"Errors": {}, "Total": 0, "Successes": 0, "Rejected": 0, "Decoded": 0}
+
+def count_error(counters, error, count=1):
+    if error not in counters["Errors"]:
+        counters["Errors"][error] = count
+    else:
+        counters["Errors"][error] += count
+
+def merge_counters(total, counters):
+    for error, count in counters["Errors"].items():
+        count_error(total, error, count)
+    for key in ("Total", "Successes", "Rejected", "Decoded"):
+        total[key] += counters[key]
+
+def expand_sources(patterns):
+    """Expand glob patterns in the input file arguments, keeping the order
+    given and sorting the matches of each pattern."""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches or [pattern])
+    return paths
+
+def open_source(path):
+    """Open an input file for reading as bytes, decompressing .gz and .zst
+    files on the fly."""
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    if path.endswith((".zst", ".zstd")):
+        if zstandard is None:
+            raise IOError("The zstandard module is needed to read {0}".format(path))
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), WRITE_BUFFER)
+    return open(path, 'rb')
+
+def convert_file(path, formatter, out, broken=None):
+    """Convert one input file, writing the formatted lines to out and, if
+    broken is given, the JSON of corrupt requests to it. Returns the file's
+    counters."""
+    counters = new_counters()
+    decoder = decode.Decoder(("netscalerHttpReqMethod",))
+    empty = b"" if formatter.binary else ""
+    pending = []
+    try:
+        with open_source(path) as f:
+            for line in f:
+                counters["Total"] += 1
+                # lines without the request method key are rejected before parsing
+                try:
+                    j = decoder.decode(line)
+                except ValueError:
+                    # a corrupt line only costs that line
+                    count_error(counters, "Invalid JSON")
+                    continue
+                try:
+                    # ensure line is a http request log
+                    if j is None or not j["netflow"].get("netscalerHttpReqMethod"):
+                        count_error(counters, "Request method not present")
+                        continue
+                    # test to ensure the log hasn't been corrupted
+                    if j["netflow"]["netscalerHttpReqMethod"] not in ("GET","POST","OPTIONS","HEAD"):
+                        count_error(counters, "Invalid request method")
+                        if broken is not None:
+                            broken.write("{0}\n".format(json.dumps(j)))
+                        continue
+                    formatted = formatter.format_json(j) + formatter.newline
+                except Exception as e:
+                    # nor does a record missing or mangling the fields used
+                    exc_type, exc_value, exc_tb = sys.exc_info()
+                    traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
+                    count_error(counters, "Invalid record")
+                    continue
+                counters["Successes"] += 1
+                pending.append(formatted)
+                if len(pending) >= WRITE_LINES:
+                    out.write(empty.join(pending))
+                    pending = []
+    except Exception as e:
+        # a truncated or corrupt rotated file should not stop the batch
+        exc_type, exc_value, exc_tb = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
+        count_error(counters, "Unreadable input file")
+    if pending:
+        out.write(empty.join(pending))
+    counters["Rejected"] = decoder.rejected
+    counters["Decoded"] = decoder.decoded
+    return counters
+
+def temp_output(tmpdir, binary):
+    fd, name = tempfile.mkstemp(prefix="ipfixout", dir=tmpdir)
+    return name, os.fdopen(fd, 'wb' if binary else 'w', WRITE_BUFFER)
+
+def convert_to_temp(task):
+    """Convert one input file into temporary files in a worker process.
+    Returns their names, to be copied out in input order, and the counters."""
+    path, fmt, fields, with_dstip, broken, tmpdir = task
+    formatter = formats.formatter(fmt, fields, with_dstip)
+    outname, out = temp_output(tmpdir, formatter.binary)
+    brokenname = None
+    brokenfile = None
+    if broken:
+        brokenname, brokenfile = temp_output(tmpdir, False)
+    with out:
+        counters = convert_file(path, formatter, out, brokenfile)
+    if brokenfile is not None:
+        brokenfile.close()
+    return outname, brokenname, counters
+
+def copy_out(name, dest, binary):
+    with open(name, 'rb' if binary else 'r') as f:
+        shutil.copyfileobj(f, dest, WRITE_BUFFER)
+    os.remove(name)
+
+def report_file(path, counters, p):
+    write_error(file_process_errors(path, counters["Errors"]), p)
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("sourcefile", type=argparse.FileType('r'), help="Input file")
-    parser.add_argument("-o", dest="destfile", type=argparse.FileType('a'), default=sys.stdout, help="Optional output file (defaults to stdout)")
+    parser.add_argument("sourcefiles", nargs="+", help="Input files or glob patterns; .gz and .zst files are decompressed")
+    parser.add_argument("-o", dest="destfile", help="Optional output file (defaults to stdout)")
     parser.add_argument("-e", dest="errorfile", type=argparse.FileType('a'), default=sys.stderr, help="Optional error file (defaults to stderr)")
     parser.add_argument("--with-host", dest="with_host", action="store_true", help="Include the destination hostname in the output")
     parser.add_argument("--with-dstip", dest="with_dstip", action="store_true", help="Include the destination IP address in the output")
     parser.add_argument("-b", dest="broken", action="store_true", help="Dump JSON output of broken lines")
     parser.add_argument("--output-broken", dest="breakfile", type=argparse.FileType('a'), default=sys.stderr, help="Store broken lines to file (defaults to stderr)")
-    parser.add_argument("-f", dest="format", default="apache", help="Specify output format")
+    parser.add_argument("-f", dest="format", default="apache", choices=sorted(formats.FORMATS), help="Specify output format")
+    parser.add_argument("--fields", dest="fields", help="Comma separated fields to output, for formats other than apache \
+(default {0})".format(",".join(formats.DEFAULT_FIELDS)))
+    parser.add_argument("-j", "--jobs", dest="jobs", default=1, type=int, help="Convert up to (n) input files at once in worker processes")
+    parser.add_argument("--tmpdir", dest="tmpdir", help="Directory for worker output before it is copied out in order \
+(defaults to the output file's directory)")
 
     p = parser.parse_args()
 
-    write_error("Processing input file {0}\n".format(p.sourcefile.name), p)
-    
-    counters = { "Errors": {}, "Total": 0, "Successes": 0}
-    for line in p.sourcefile:
-        j = json.loads(line)
-        # ensure line is a http request log
-        if j["netflow"].get("netscalerHttpReqMethod"):
-            # test to ensure the log hasn't been corrupted
-            if j["netflow"]["netscalerHttpReqMethod"] not in ("GET","POST","OPTIONS","HEAD"):
-                if "Invalid request method" not in counters["Errors"]:
-                    counters["Errors"]["Invalid request method"] = 1
-                else:
-                    counters["Errors"]["Invalid request method"] += 1
-                if p.broken:
-                    p.breakfile.write("{0}\n".format(json.dumps(j)))
-            else:
-                counters["Successes"] += 1
-                output_line(j, p)
+    try:
+        formatter = formats.formatter(p.format, p.fields, p.with_dstip)
+    except ValueError as e:
+        parser.error(str(e))
+    if p.destfile:
+        tmpdir = p.tmpdir or os.path.dirname(os.path.abspath(p.destfile))
+        p.destfile = open(p.destfile, 'ab' if formatter.binary else 'a', WRITE_BUFFER)
+    else:
+        tmpdir = p.tmpdir
+        if formatter.binary:
+            p.destfile = getattr(sys.stdout, "buffer", sys.stdout)
         else:
-            if "Request method not present" not in counters["Errors"]:
-                counters["Errors"]["Request method not present"] = 1
-            else:
-                counters["Errors"]["Request method not present"] += 1
-        
-        counters["Total"] += 1
-    
-    write_error(file_process_errors(p.sourcefile.name, counters["Errors"]), p)
-    write_error("Successfully output {0} lines to {1}.\n".format(counters["Successes"], p.destfile.name), p)
+            p.destfile = sys.stdout
+    broken = p.breakfile if p.broken else None
+
+    paths = expand_sources(p.sourcefiles)
+    counters = new_counters()
+    if p.jobs > 1 and len(paths) > 1:
+        tasks = [(path, p.format, p.fields, p.with_dstip, p.broken, tmpdir) for path in paths]
+        pool = multiprocessing.Pool(min(p.jobs, len(paths)))
+        try:
+            # results come back in input order while later files are still
+            # being converted
+            for path, (outname, brokenname, filecounters) in zip(paths, pool.imap(convert_to_temp, tasks)):
+                write_error("Processing input file {0}\n".format(path), p)
+                copy_out(outname, p.destfile, formatter.binary)
+                if brokenname is not None:
+                    copy_out(brokenname, broken, False)
+                report_file(path, filecounters, p)
+                merge_counters(counters, filecounters)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for path in paths:
+            write_error("Processing input file {0}\n".format(path), p)
+            filecounters = convert_file(path, formatter, p.destfile, broken)
+            report_file(path, filecounters, p)
+            merge_counters(counters, filecounters)
+    p.destfile.flush()
+
+    if len(paths) > 1:
+        write_error("Errors encountered processing {0} input files: {1}\n".format(len(paths), json.dumps(counters["Errors"])), p)
+    write_error("Successfully output {0} lines to {1}.\n".format(counters["Successes"], getattr(p.destfile, "name", "stdout")), p)
+    write_error("Rejected {0} lines before decoding, decoded {1} lines with {2}.\n".format(counters["Rejected"], counters["Decoded"], decode.backend), p)
     write_error("Parsing completed on {0} lines, exiting.\n".format(counters["Total"]), p)
 
 
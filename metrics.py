@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+import os, time, logging, threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("{0}{1} {2}".format(name, format_labels(labels), format_value(value)))
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(labels[n] for n in self.labelnames)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, tuple(zip(self.labelnames, key)), value) for key, value in items]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_max(self, value, **labels):
+        """Raise the gauge to value if it is higher, for high-water marks."""
+        key = self._key(labels)
+        with self._lock:
+            if value > self._values.get(key, 0):
+                self._values[key] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        super(Histogram, self).__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, total, count = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key][1] = total + value
+            self._values[key][2] = count + 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((key, (list(v[0]), v[1], v[2])) for key, v in self._values.items())
+        for key, (counts, total, count) in items:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                samples.append((self.name + "_bucket", labels + (("le", format_value(bound)),), cumulative))
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, count))
+        return samples
+
+class Laps(object):
+    """Split elapsed time between named stages of a loop. Each call to lap()
+    charges the time since the previous call to the given stage."""
+    def __init__(self):
+        self.totals = {}
+        self._last = time.time()
+
+    def lap(self, stage):
+        now = time.time()
+        self.totals[stage] = self.totals.get(stage, 0.0) + now - self._last
+        self._last = now
+
+def serve(host, port, registry=REGISTRY):
+    """Serve the registry over HTTP from a daemon thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("Metrics request from {0}".format(self.client_address[0]))
+
+    server = HTTPServer((host, port), MetricsHandler)
+    t = threading.Thread(target=server.serve_forever, name="metrics")
+    t.daemon = True
+    t.start()
+    logger.info("Serving metrics on http://{0}:{1}/metrics".format(host, server.server_port))
+    return server
+
+def write_file(path, registry=REGISTRY):
+    tmpfile = path + ".tmp"
+    with open(tmpfile, 'w') as f:
+        f.write(registry.render())
+    os.rename(tmpfile, path)
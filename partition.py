@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""Correlation spread across worker processes by transaction ID.
+
+Raw lines are routed to a partition by (source, netscalerTransactionId),
+which is picked out of the line without decoding it, so a request and its
+response always meet in the same worker. Each worker decodes its lines,
+holds one TransactionTable per source for its slice of the state, and sends
+back the formatted output. Batches carry a sequence number per source and
+results are gathered back into that order, along with the state changes
+needed for the source's checkpoint.
+"""
+import os, re, sys, time, signal, logging, traceback, collections, multiprocessing
+import decode, transactions, formats, spill, archive
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger(__name__)
+
+TXID_MARKER = b'"netscalerTransactionId":'
+TXID_VALUE = re.compile(br'\s*(\d+)')
+HTTP_MARKERS = tuple(('"{0}"'.format(k)).encode("ascii") for k in decode.HTTP_KEYS)
+# how often an idle worker checks that watch.py is still running
+PARENT_CHECK_SECONDS = 1
+
+def txid_of(line):
+    """Return the netscalerTransactionId in a raw Logstash line, or None."""
+    i = line.find(TXID_MARKER)
+    if i < 0:
+        return None
+    m = TXID_VALUE.match(line, i + len(TXID_MARKER))
+    if m is None:
+        return None
+    return int(m.group(1))
+
+def correlate_lines(table, lines, decoder, formatter, rows=None):
+    """Decode lines, feed them to table and return the formatted output lines
+    and the number of lines that raised an exception. If rows is a list,
+    archive rows for the output are added to it."""
+    out = []
+    ex = 0
+    for l in lines:
+        try:
+            ljson = decoder.decode(l)
+            if ljson is not None:
+                completed = table.feed(ljson)
+                for t in completed:
+                    out.append(formatter.format(t) + formatter.newline)
+                if rows is not None:
+                    rows.extend(map(archive.row, completed))
+        except Exception as e:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
+            ex += 1
+    return out, ex
+
+def worker(partition, inbox, replies, maxreq, maxres, ttl, fmt, fields, spilling, archiving):
+    # forked with watch.py's handlers, which only set a flag; SIGTERM should
+    # end a worker, and SIGINT reaches the parent too, which stops the workers
+    # once it has drained its pipelines
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent = os.getppid()
+    formatter = formats.formatter(fmt, fields)
+    tables = {}
+    while True:
+        try:
+            message = inbox.get(timeout=PARENT_CHECK_SECONDS)
+        except queue.Empty:
+            if os.getppid() != parent:
+                logger.warning("Partition {0} exiting, watch.py has gone".format(partition))
+                break
+            continue
+        if message[0] == "stop":
+            break
+        kind, source, seq = message[:3]
+        if source not in tables:
+            store = None
+            if spilling is not None:
+                path, spillttl, spillmax = spilling
+                store = spill.SpillStore(os.path.join(path, "partition-{0}-{1}.spill".format(partition, source)), spillttl, spillmax)
+            tables[source] = transactions.TransactionTable(maxreq, maxres, ttl, store)
+        table = tables[source]
+        if kind == "restore":
+            for k, t in message[3]:
+                table.restore(k, t)
+            # restored entries are already in the source's checkpoint
+            table.take_delta()
+        elif kind == "dump":
+            replies[source].put((seq, partition, {"req_all": list(table.pending("req")), "res_all": list(table.pending("res"))}))
+        elif kind == "batch":
+            lines, want = message[3:]
+            start = time.time()
+            decoder = decode.Decoder(decode.HTTP_KEYS)
+            evicted, dropped = table.evicted, table.dropped
+            rows = [] if archiving else None
+            out, ex = correlate_lines(table, lines, decoder, formatter, rows)
+            result = {"lines": out, "rows": rows, "errors": ex,
+                      "rejected": decoder.rejected, "decoded": decoder.decoded,
+                      "evicted": table.evicted - evicted, "dropped": table.dropped - dropped,
+                      "req": len(table.req), "res": len(table.res), "clock": table.clock,
+                      "spill": len(table.spill) if table.spill is not None else 0}
+            if want:
+                result["delta"] = table.take_delta()
+            if want == "snapshot":
+                result["req_all"] = list(table.pending("req"))
+                result["res_all"] = list(table.pending("res"))
+            result["seconds"] = time.time() - start
+            replies[source].put((seq, partition, result))
+    for table in tables.values():
+        table.close()
+
+class StateView(object):
+    """One source's state gathered from every partition, in the shape
+    Checkpoint expects of a TransactionTable."""
+    def __init__(self, results):
+        added = []
+        removed = []
+        self.req = collections.OrderedDict()
+        self.res = collections.OrderedDict()
+        for result in results:
+            if "delta" in result:
+                added.extend(result["delta"][0])
+                removed.extend(result["delta"][1])
+            for t in result.get("req_all", ()):
+                self.req[t.txid] = t
+            for t in result.get("res_all", ()):
+                self.res[t.txid] = t
+        self._delta = (added, removed)
+
+    def pending(self, kind):
+        return getattr(self, kind).values()
+
+    def take_delta(self):
+        delta = self._delta
+        self._delta = ([], [])
+        return delta
+
+class Result(object):
+    """The per-partition results of one batch, gathered by get()."""
+    def __init__(self, partitions, source, seq):
+        self.partitions = partitions
+        self.source = source
+        self.seq = seq
+
+    def get(self):
+        return self.partitions.collect(self.source, self.seq)
+
+class Partitions(object):
+    """Worker processes sharing the correlation of every source.
+
+    --max-state and --spill-max are split evenly between the partitions. Only one thread per
+    source may collect results, and it must do so in the order batches were
+    dispatched.
+    """
+    def __init__(self, count, sources, args):
+        self.count = count
+        self.inboxes = [multiprocessing.Queue(args.queuesize) for i in range(count)]
+        self.replies = [multiprocessing.Queue() for s in range(sources)]
+        self._seq = [0] * sources
+        self._results = [{} for s in range(sources)]
+        maxreq = max(1, (args.maxstate + count - 1) // count)
+        spilling = None
+        if args.spill:
+            spilling = (args.outpath, args.spillttl, max(1, (args.spillmax + count - 1) // count) if args.spillmax else 0)
+        self.procs = [multiprocessing.Process(target=worker, name="partition-{0}".format(i),
+                                              args=(i, self.inboxes[i], self.replies, maxreq, maxreq * 5, args.statettl, args.format, args.fields, spilling, bool(args.archive)))
+                      for i in range(count)]
+
+    def start(self):
+        for proc in self.procs:
+            proc.daemon = True
+            proc.start()
+        logger.info("Started {0} correlation partitions".format(self.count))
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(("stop",))
+        for proc in self.procs:
+            proc.join()
+
+    def partition(self, source, txid):
+        if txid is None:
+            return 0
+        return hash((source, txid)) % self.count
+
+    def restore(self, source, state):
+        """Hand a source's loaded state to the partitions that own each entry."""
+        slices = [[] for i in range(self.count)]
+        for kind in ("req", "res"):
+            for t in state.pending(kind):
+                slices[self.partition(source, t.txid)].append((kind, t))
+        for i, items in enumerate(slices):
+            self.inboxes[i].put(("restore", source, None, items))
+
+    def split(self, source, lines):
+        """Route raw lines to partitions, dropping those that cannot be HTTP
+        records. Returns the per-partition lists and the number dropped."""
+        slices = [[] for i in range(self.count)]
+        rejected = 0
+        for l in lines:
+            for marker in HTTP_MARKERS:
+                if marker in l:
+                    break
+            else:
+                rejected += 1
+                continue
+            slices[self.partition(source, txid_of(l))].append(l)
+        return slices, rejected
+
+    def dispatch(self, source, slices, want=None):
+        """Send one batch of routed lines. want is None, "delta" to collect
+        the state changes since the last delta, or "snapshot" to also collect
+        the full state. Blocks while a partition's queue is full."""
+        seq = self._seq[source]
+        self._seq[source] += 1
+        for i, lines in enumerate(slices):
+            self.inboxes[i].put(("batch", source, seq, lines, want))
+        return Result(self, source, seq)
+
+    def collect(self, source, seq):
+        pending = self._results[source]
+        while len(pending.get(seq, ())) < self.count:
+            rseq, partition, result = self.replies[source].get()
+            pending.setdefault(rseq, {})[partition] = result
+        results = pending.pop(seq)
+        return [results[i] for i in range(self.count)]
+
+    def dump(self, source):
+        """Return a StateView of everything the partitions hold for a source."""
+        seq = self._seq[source]
+        self._seq[source] += 1
+        for inbox in self.inboxes:
+            inbox.put(("dump", source, seq))
+        return StateView(self.collect(source, seq))
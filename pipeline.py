@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+import sys, logging, threading, traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger(__name__)
+
+# passed down the pipeline by close() behind the last real item
+STOP = object()
+# how long a stage with an idle handler waits for an item before calling it
+IDLE_SECONDS = 1
+
+class Ready(object):
+    """Stands in for a pool AsyncResult when the work was done inline."""
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+class Stage(object):
+    """Run handler(item) for each item on a bounded queue, in its own thread.
+
+    Anything the handler returns other than None is put on the next stage's
+    queue. Puts block while that queue is full, so a slow stage holds back
+    the stages before it instead of letting work pile up in memory. idle, if
+    given, is called from the same thread while no item has arrived for
+    IDLE_SECONDS.
+    """
+    def __init__(self, name, handler, maxsize, idle=None):
+        self.name = name
+        self.handler = handler
+        self.idle = idle
+        self.queue = queue.Queue(maxsize)
+        self.next = None
+        self.forward_stop = True
+        self.depth = None
+        self._thread = None
+
+    def put(self, item):
+        self.queue.put(item)
+        if self.depth is not None:
+            self.depth.set(self.queue.qsize(), stage=self.name)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        while True:
+            if self.idle is None:
+                item = self.queue.get()
+            else:
+                try:
+                    item = self.queue.get(timeout=IDLE_SECONDS)
+                except queue.Empty:
+                    try:
+                        self.idle()
+                    except Exception as e:
+                        exc_type, exc_value, exc_tb = sys.exc_info()
+                        traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
+                    continue
+            if self.depth is not None:
+                self.depth.set(self.queue.qsize(), stage=self.name)
+            if item is STOP:
+                break
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
+                continue
+            if result is not None and self.next is not None:
+                self.next.put(result)
+        if self.next is not None and self.forward_stop:
+            self.next.put(STOP)
+        logger.debug("Stage {0} finished".format(self.name))
+
+class Pipeline(object):
+    """A chain of Stages, fed through put(). close() lets every item already
+    queued run through to the end before the threads exit. depth, if given,
+    is a metrics.Gauge with a stage label for the queue lengths.
+
+    sink, if given, is anything with a put() that the last stage's results
+    go to. It is not stopped by close(), so several pipelines can share one.
+    """
+    def __init__(self, stages, depth=None, sink=None):
+        self.stages = stages
+        for stage, following in zip(stages, stages[1:]):
+            stage.next = following
+        if sink is not None:
+            stages[-1].next = sink
+            stages[-1].forward_stop = False
+        for stage in stages:
+            stage.depth = depth
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def close(self):
+        self.put(STOP)
+        for stage in self.stages:
+            stage.join()
+        logger.info("Pipeline drained")
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""On-disk overflow for a TransactionTable.
+
+Once a table holds --max-state requests (or five times that many responses)
+in memory, the oldest entries move to a local sqlite database instead of
+being written out with a placeholder status or dropped. They can still be
+matched by a late partner from there, until they are more than ttl seconds
+older than the newest record seen or the store holds more than maxsize
+entries, at which point they are written out (or dropped) as before.
+
+The transaction IDs held on disk are also kept in memory, so records with no
+spilled partner never touch the database.
+
+Spilled entries are still pending state as far as the checkpoint is
+concerned, and are saved in snapshots with the rest. The database itself is
+scratch space: it is recreated empty on start and removed on close.
+"""
+import os, pickle, sqlite3, logging
+
+logger = logging.getLogger(__name__)
+
+class SpillStore(object):
+    def __init__(self, path, ttl=600, maxsize=0):
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        for stale in (path, path + "-journal"):
+            if os.path.exists(stale):
+                os.remove(stale)
+        # only ever used by one thread at a time, but not always the one
+        # that opened it
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=OFF")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("PRAGMA locking_mode=EXCLUSIVE")
+        self._db.execute("CREATE TABLE spill (seq INTEGER PRIMARY KEY, kind TEXT, txid INTEGER, epoch INTEGER, data BLOB)")
+        self._db.execute("CREATE UNIQUE INDEX spill_txid ON spill (kind, txid)")
+        self._db.execute("CREATE INDEX spill_epoch ON spill (epoch)")
+        # nothing else reads the file and nothing in it needs to survive a
+        # crash, so one transaction left open saves a commit per change
+        self._db.execute("BEGIN")
+        self.txids = {"req": set(), "res": set()}
+
+    def __len__(self):
+        return len(self.txids["req"]) + len(self.txids["res"])
+
+    def has(self, kind, txid):
+        return txid in self.txids[kind]
+
+    def put(self, kind, transaction):
+        self._db.execute("INSERT OR REPLACE INTO spill (kind, txid, epoch, data) VALUES (?, ?, ?, ?)",
+                         (kind, transaction.txid, transaction.epoch, sqlite3.Binary(pickle.dumps(transaction, 2))))
+        self.txids[kind].add(transaction.txid)
+
+    def pop(self, kind, txid):
+        row = self._db.execute("SELECT seq, data FROM spill WHERE kind = ? AND txid = ?", (kind, txid)).fetchone()
+        self._db.execute("DELETE FROM spill WHERE seq = ?", (row[0],))
+        self.txids[kind].discard(txid)
+        return pickle.loads(bytes(row[1]))
+
+    def discard(self, kind, txid):
+        if txid in self.txids[kind]:
+            self.pop(kind, txid)
+
+    def values(self, kind):
+        """Yield the spilled entries of a kind, oldest first."""
+        for row in self._db.execute("SELECT data FROM spill WHERE kind = ? ORDER BY seq", (kind,)).fetchall():
+            yield pickle.loads(bytes(row[0]))
+
+    def expire(self, clock):
+        """Remove and return (kind, Transaction) for every entry more than ttl
+        seconds older than clock, then for the oldest entries over maxsize."""
+        expired = []
+        if not len(self):
+            return expired
+        if self.ttl:
+            rows = self._db.execute("SELECT seq, kind, data FROM spill WHERE epoch < ? ORDER BY seq", (clock - self.ttl,)).fetchall()
+            if rows:
+                self._db.execute("DELETE FROM spill WHERE epoch < ?", (clock - self.ttl,))
+                expired.extend(self._unpack(rows))
+        over = len(self) - self.maxsize
+        if self.maxsize and over > 0:
+            rows = self._db.execute("SELECT seq, kind, data FROM spill ORDER BY seq LIMIT ?", (over,)).fetchall()
+            self._db.execute("DELETE FROM spill WHERE seq <= ?", (rows[-1][0],))
+            expired.extend(self._unpack(rows))
+        return expired
+
+    def _unpack(self, rows):
+        entries = []
+        for seq, kind, data in rows:
+            transaction = pickle.loads(bytes(data))
+            self.txids[kind].discard(transaction.txid)
+            entries.append((kind, transaction))
+        return entries
+
+    def close(self):
+        if self._db is None:
+            return
+        self._db.close()
+        self._db = None
+        os.remove(self.path)
+
+def open_store(args, name):
+    """Return the SpillStore for the state saved under a checkpoint name, or
+    None if spilling is off."""
+    if not args.spill:
+        return None
+    return SpillStore(os.path.join(args.outpath, name + ".spill"), args.spillttl, args.spillmax)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import time, logging, threading, traceback, sys
+
+logger = logging.getLogger(__name__)
+
+class TailScheduler(object):
+    """Run reads of a growing file from one thread, merging bursts of
+    filesystem events into single reads.
+
+    process(maxbytes) is called to read at most maxbytes, and must return a
+    tuple of (bytes consumed, bytes still unread); process(None) must read
+    just the next complete line, however long. After the first event of a
+    burst the scheduler waits interval seconds for more to arrive before
+    reading. While reads leave data behind it reads again straight away,
+    doubling the batch size and interval up to their maximums; once caught up
+    both are halved back towards their minimums to keep latency low. A line
+    longer than the batch doubles the batch until it fits, or past the
+    maximum is read on its own.
+
+    In polling mode no events are needed: the file is checked every interval
+    seconds instead, for filesystems where inotify events are unreliable.
+    """
+    def __init__(self, process, interval=0.05, max_interval=1.0, batch=1048576, max_batch=67108864, poll=False):
+        self.process = process
+        self.min_interval = interval
+        self.max_interval = max_interval
+        self.min_batch = batch
+        self.max_batch = max_batch
+        self.interval = interval
+        self.batch = batch
+        self.poll = poll
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def notify(self):
+        self._wakeup.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="tail")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop after the read in progress, if any, has finished."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        logger.info("Stopped tailing")
+
+    def run(self):
+        while not self._stopping:
+            if self.poll:
+                self._wakeup.wait(self.interval)
+            else:
+                # wake up regularly so that stop() is noticed
+                self._wakeup.wait(self.max_interval)
+                if not self._wakeup.is_set():
+                    continue
+                # let the rest of the burst arrive
+                time.sleep(self.interval)
+            if self._stopping:
+                break
+            self._wakeup.clear()
+            self.catch_up()
+
+    def catch_up(self):
+        while not self._stopping:
+            try:
+                consumed, remaining = self.process(self.batch)
+                if not consumed and remaining >= self.batch:
+                    # no line ends within the batch
+                    if self.batch < self.max_batch:
+                        self.batch = min(self.batch * 2, self.max_batch)
+                        continue
+                    consumed, remaining = self.process(None)
+                    if not consumed:
+                        # still being written
+                        return
+            except Exception as e:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
+                return
+            # a partial line at the end of the file leaves bytes unread
+            # without any progress, which is not falling behind
+            behind = consumed > 0 and remaining > 0
+            self.adapt(behind)
+            if not behind:
+                return
+
+    def adapt(self, behind):
+        if behind:
+            self.batch = min(self.batch * 2, self.max_batch)
+            self.interval = min(self.interval * 2, self.max_interval)
+            logger.debug("Behind input, batch size {0} interval {1}".format(self.batch, self.interval))
+        else:
+            self.batch = max(self.batch // 2, self.min_batch)
+            self.interval = max(self.interval / 2, self.min_interval)
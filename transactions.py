@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+import time, calendar, logging, collections
+
+logger = logging.getLogger(__name__)
+
+HTTP_METHODS = ("GET", "POST", "HEAD", "OPTIONS")
+
+# netflow fields kept for each pending transaction; everything else in the
+# Logstash record is dropped on the way in
+NETFLOW_FIELDS = (
+    ("txid", "netscalerTransactionId"),
+    ("srcip", "sourceIPv4Address"),
+    ("dstip", "destinationIPv4Address"),
+    ("method", "netscalerHttpReqMethod"),
+    ("url", "netscalerHttpReqUrl"),
+    ("referer", "netscalerHttpReqReferer"),
+    ("useragent", "netscalerHttpReqUserAgent"),
+    ("host", "netscalerHttpDomainName"),
+    ("status", "netscalerHttpRspStatus"),
+    ("size", "netscalerHttpRspLen"),
+)
+
+_last_epoch = (None, 0)
+
+def timestamp_epoch(timestamp):
+    # records arrive in runs sharing the same second, so remembering the last
+    # conversion avoids most strptime calls. The key and epoch are replaced
+    # together, as each source's correlate thread calls this.
+    global _last_epoch
+    key = timestamp[:19]
+    last = _last_epoch
+    if last[0] == key:
+        return last[1]
+    epoch = calendar.timegm(time.strptime(key, '%Y-%m-%dT%H:%M:%S'))
+    _last_epoch = (key, epoch)
+    return epoch
+
+def trim(line_json):
+    """Return a copy of a decoded Logstash record holding only the kept fields."""
+    netflow = line_json["netflow"]
+    return {"@timestamp": line_json["@timestamp"],
+            "netflow": dict((field, netflow[field]) for attr, field in NETFLOW_FIELDS if field in netflow)}
+
+class Transaction(object):
+    __slots__ = ("timestamp", "epoch") + tuple(attr for attr, field in NETFLOW_FIELDS)
+
+    def __init__(self, timestamp, netflow):
+        self.timestamp = timestamp
+        self.epoch = timestamp_epoch(timestamp)
+        for attr, field in NETFLOW_FIELDS:
+            setattr(self, attr, netflow.get(field))
+
+    @classmethod
+    def from_json(cls, line_json):
+        return cls(line_json["@timestamp"], line_json["netflow"])
+
+    def as_json(self):
+        """Rebuild the subset of the Logstash record that was kept."""
+        netflow = {}
+        for attr, field in NETFLOW_FIELDS:
+            value = getattr(self, attr)
+            if value is not None:
+                netflow[field] = value
+        return {"@timestamp": self.timestamp, "netflow": netflow}
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, values):
+        for attr, value in zip(self.__slots__, values):
+            setattr(self, attr, value)
+
+class TransactionTable(object):
+    """Pending HTTP requests and responses keyed by netscalerTransactionId.
+
+    Entries are evicted oldest first once a table holds more than its maximum
+    count, or once they are more than ttl seconds older than the newest
+    @timestamp seen (ttl of 0 disables age based eviction). Evicted requests
+    are handed back to the caller to be written with a placeholder status of
+    0; evicted responses are dropped.
+
+    With a spill.SpillStore, entries over the maximum count move to it rather
+    than being evicted, and are only evicted from there by its own ttl and
+    size limits.
+    """
+    def __init__(self, maxreq, maxres, ttl=0, spill=None):
+        self.req = collections.OrderedDict()
+        self.res = collections.OrderedDict()
+        self.maxreq = maxreq
+        self.maxres = maxres
+        self.ttl = ttl
+        self.spill = spill
+        self.clock = 0
+        self.evicted = 0
+        self.dropped = 0
+        # changes since the last take_delta(), for incremental checkpoints
+        self._added = collections.OrderedDict()
+        self._removed = set()
+
+    def __len__(self):
+        return len(self.req) + len(self.res)
+
+    def feed(self, line_json):
+        """Add one decoded record to the table and return a list of completed
+        Transactions that are ready to be written out."""
+        netflow = line_json["netflow"]
+        completed = []
+
+        if "netscalerHttpReqMethod" in netflow:
+            if netflow["netscalerHttpReqMethod"] in HTTP_METHODS:
+                txid = netflow["netscalerTransactionId"]
+                if txid in self.res or self._spilled("res", txid):
+                    logger.debug("Transaction ID {0} found in response state, writing out".format(txid))
+                    # if the response is already known, write immediately
+                    request = Transaction.from_json(line_json)
+                    request.status = self._pop("res", txid).status
+                    completed.append(request)
+                elif txid not in self.req and not self._spilled("req", txid):
+                    logger.debug("New Transaction ID {0} found, adding to table".format(txid))
+                    request = Transaction.from_json(line_json)
+                    completed.extend(self._advance(request.epoch))
+                    while len(self.req) > self.maxreq:
+                        completed.append(self._evict_request())
+                    self.restore("req", request)
+
+        if "netscalerHttpRspStatus" in netflow:
+            txid = netflow["netscalerTransactionId"]
+            if txid in self.req or self._spilled("req", txid):
+                logger.debug("Transaction ID {0} found in request state, writing out".format(txid))
+                # if request is present in state table, write immediately
+                request = self._pop("req", txid)
+                request.status = netflow["netscalerHttpRspStatus"]
+                completed.append(request)
+            else:
+                response = Transaction.from_json(line_json)
+                completed.extend(self._advance(response.epoch))
+                while len(self.res) > self.maxres:
+                    logger.debug("Max response state size reached, purging oldest flow")
+                    self._drop_response()
+                self.restore("res", response)
+
+        return completed
+
+    def expire(self):
+        """Evict everything older than the TTL, returning the requests."""
+        expired = []
+        if self.ttl:
+            horizon = self.clock - self.ttl
+            while self.req and next(iter(self.req.values())).epoch < horizon:
+                expired.append(self._evict_request())
+            while self.res and next(iter(self.res.values())).epoch < horizon:
+                self._drop_response()
+        if self.spill is not None:
+            for kind, transaction in self.spill.expire(self.clock):
+                self._forget(kind, transaction.txid)
+                if kind == "req":
+                    transaction.status = 0
+                    self.evicted += 1
+                    expired.append(transaction)
+                else:
+                    self.dropped += 1
+        return expired
+
+    def _advance(self, epoch):
+        if epoch > self.clock:
+            self.clock = epoch
+            return self.expire()
+        return []
+
+    def restore(self, kind, transaction):
+        """Add a pending request ("req") or response ("res") to the table."""
+        table = getattr(self, kind)
+        table[transaction.txid] = transaction
+        self._added[(kind, transaction.txid)] = transaction
+        if transaction.epoch > self.clock:
+            self.clock = transaction.epoch
+        if self.spill is not None:
+            self.spill.discard(kind, transaction.txid)
+            if len(table) > (self.maxreq if kind == "req" else self.maxres):
+                # still pending, so not a change for the checkpoint
+                self.spill.put(kind, table.popitem(last=False)[1])
+
+    def discard(self, kind, txid):
+        if txid in getattr(self, kind) or self._spilled(kind, txid):
+            self._pop(kind, txid)
+
+    def pending(self, kind):
+        """Yield every pending request or response, spilled ones (which are
+        the oldest) first."""
+        if self.spill is not None:
+            for transaction in self.spill.values(kind):
+                yield transaction
+        for transaction in getattr(self, kind).values():
+            yield transaction
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+    def take_delta(self):
+        """Return the (kind, Transaction) pairs added and the (kind, txid)
+        pairs removed since the last call, and start a new delta. Removals
+        must be applied before additions when replaying a delta."""
+        added = [(kind, t) for (kind, txid), t in self._added.items()]
+        removed = list(self._removed)
+        self._added = collections.OrderedDict()
+        self._removed = set()
+        return added, removed
+
+    def _spilled(self, kind, txid):
+        return self.spill is not None and self.spill.has(kind, txid)
+
+    def _forget(self, kind, txid):
+        if self._added.pop((kind, txid), None) is None:
+            self._removed.add((kind, txid))
+
+    def _pop(self, kind, txid):
+        self._forget(kind, txid)
+        try:
+            return getattr(self, kind).pop(txid)
+        except KeyError:
+            return self.spill.pop(kind, txid)
+
+    def _drop_response(self):
+        self._pop("res", next(iter(self.res)))
+        self.dropped += 1
+
+    def _evict_request(self):
+        txid = next(iter(self.req))
+        request = self._pop("req", txid)
+        logger.debug("Evicting request state, writing out Transaction ID {0}".format(txid))
+        # set placeholder response code
+        request.status = 0
+        self.evicted += 1
+        return request
+
+    def load_dict(self, saved):
+        # JSON turns the transaction ID keys into strings, so key on the
+        # value held in the record instead
+        for kind in ("req", "res"):
+            for old in saved[kind].values():
+                self.restore(kind, Transaction.from_json(old))
@@ -1,91 +1,168 @@
 #!/usr/bin/env python
 
-import sys, time, os, logging, json, ipfixout, glob, argparse, datetime, traceback, collections, signal, Queue, sched, threading
+import sys, time, os, logging, json, formats, transactions, decode, writers, checkpoint, metrics, tail, pipeline, partition, spill, archive, glob, argparse, datetime, traceback, collections, signal, sched, threading, mmap, multiprocessing
 from watchdog.observers import Observer
 from watchdog.events import RegexMatchingEventHandler
 
 logger = logging.getLogger(__name__)
-q = Queue.Queue()
 statstime = 60
+metricsfile = None
+watchpaths = []
+
+LINES_READ = metrics.Counter("ipfixwatch_lines_read_total", "Input lines read")
+LINES_REJECTED = metrics.Counter("ipfixwatch_lines_rejected_total", "Input lines rejected before JSON decoding")
+LINES_DECODED = metrics.Counter("ipfixwatch_lines_decoded_total", "Input lines decoded as JSON")
+LINE_ERRORS = metrics.Counter("ipfixwatch_line_errors_total", "Input lines that raised an exception")
+ROWS_WRITTEN = metrics.Counter("ipfixwatch_rows_written_total", "Output lines written")
+PLACEHOLDERS = metrics.Counter("ipfixwatch_placeholder_requests_total", "Requests evicted from state and written with a placeholder status")
+DROPPED = metrics.Counter("ipfixwatch_dropped_responses_total", "Responses evicted from state without a matching request")
+STAGE_SECONDS = metrics.Counter("ipfixwatch_stage_seconds_total", "Time spent in each processing stage", ["stage"])
+BATCH_SECONDS = metrics.Histogram("ipfixwatch_batch_stage_seconds", "Time spent in each processing stage per batch of input", ["stage"])
+STATE_SIZE = metrics.Gauge("ipfixwatch_state_size", "Pending transactions held in state", ["source", "table"])
+STATE_SIZE_MAX = metrics.Gauge("ipfixwatch_state_size_max", "Highest number of pending transactions held in state", ["source", "table"])
+LAG_BYTES = metrics.Gauge("ipfixwatch_lag_bytes", "Bytes between the read position and the end of the current input file", ["source"])
+LAG_SECONDS = metrics.Gauge("ipfixwatch_lag_seconds", "Seconds between now and the newest @timestamp held in state", ["source"])
+QUEUE_DEPTH = metrics.Gauge("ipfixwatch_queue_depth", "Batches waiting in front of each live pipeline stage", ["stage"])
 
 class ObjectDict(dict):
     def __getattr__(self, name):
         return self.__getitem__(name)
 
-def process_file(path, position, state, args):
+def read_lines(f, position, chunksize=1048576, use_mmap=False, end=None):
+    """Yield (line, end position) for each complete line in f after position.
+
+    The file is consumed in chunks of at most chunksize bytes (or through a
+    read-only mmap), so memory stays flat however far behind the reader is. A
+    trailing line with no newline yet is not yielded; callers only advance
+    their position to the last end position seen, so the next call reads the
+    half-written record again in full. If end is given, reading stops there,
+    and a line not complete by then is likewise left for the next call.
+    """
+    if use_mmap:
+        size = os.fstat(f.fileno()).st_size
+        if size <= position:
+            return
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            nl = m.find(b"\n", position)
+            while nl != -1 and (end is None or nl < end):
+                yield m[position:nl + 1], nl + 1
+                position = nl + 1
+                nl = m.find(b"\n", position)
+        finally:
+            m.close()
+        return
+
+    f.seek(position)
+    partial = b""
+    remaining = None if end is None else end - position
+    while True:
+        if remaining is not None:
+            chunk = f.read(min(chunksize, remaining))
+            remaining -= len(chunk)
+        else:
+            chunk = f.read(chunksize)
+        if not chunk:
+            break
+        buf = partial + chunk
+        start = 0
+        nl = buf.find(b"\n")
+        while nl != -1:
+            position += nl + 1 - start
+            yield buf[start:nl + 1], position
+            start = nl + 1
+            nl = buf.find(b"\n", start)
+        partial = buf[start:]
+
+def get_formatter(args):
+    return formats.formatter(args.format, args.fields)
+
+def output_name(path, args):
+    return os.path.join(args.outpath, os.path.basename(path).split("_")[0] + "-netscaler_http" + get_formatter(args).suffix)
+
+_archives = {}
+
+def get_archive(args):
+    """Return the archive.Archive for --archive, or None. One is shared by
+    the backlog and live paths."""
+    if not args.archive:
+        return None
+    if args.archive not in _archives:
+        _archives[args.archive] = archive.Archive(args.archive)
+    return _archives[args.archive]
+
+def write_completed(completed, writer, outname, args):
+    formatter = get_formatter(args)
+    for outline in completed:
+        writer.write(outname, formatter.format(outline) + formatter.newline)
+    if completed and args.archive:
+        get_archive(args).add(list(map(archive.row, completed)))
+    return len(completed)
+
+def record_laps(laps):
+    for stage, seconds in laps.totals.items():
+        STAGE_SECONDS.inc(seconds, stage=stage)
+        BATCH_SECONDS.observe(seconds, stage=stage)
+
+def record_state_size(source, table, size):
+    STATE_SIZE.set(size, source=source, table=table)
+    STATE_SIZE_MAX.set_max(size, source=source, table=table)
+
+def record_metrics(state, laps, evicted, dropped, source):
+    """Update the stage timings and state metrics after a batch. evicted and
+    dropped are the state table's counters from before the batch, source
+    the source_name() of the directory it was read from."""
+    record_laps(laps)
+    PLACEHOLDERS.inc(state.evicted - evicted)
+    DROPPED.inc(state.dropped - dropped)
+    for table in ("req", "res"):
+        record_state_size(source, table, len(getattr(state, table)))
+    if state.spill is not None:
+        record_state_size(source, "spill", len(state.spill))
+
+def process_file(path, position, state, args, writer=None):
     logger.debug("Start processing on {0} at position {1}".format(path, position))
     setattr(args, "with_srcip", True)
     setattr(args, "with_dstip", True)
 
-    with open(path) as f:
+    with open(path, 'rb') as f:
         try:
             last_position = position
-            outname = os.path.join(args.outpath, os.path.basename(f.name).split("_")[0] + "-netscaler_http_apache.txt")
-            f.seek(position)
-            loglines = f.readlines()
-            last_position = f.tell()
-            logger.debug("Read {0} lines from {1}".format(len(loglines), path))
+            outname = output_name(path, args)
+            decoder = decode.Decoder(decode.HTTP_KEYS)
+            rl = 0
             ex = 0
             wl = 0
-            with open(outname, 'a') as o:
-                for l in loglines:
+            own_writer = writer is None
+            if own_writer:
+                writer = new_writer(args)
+            laps = metrics.Laps()
+            evicted, dropped = state.evicted, state.dropped
+            try:
+                for l, endpos in read_lines(f, position, args.readchunk, args.mmap):
+                    laps.lap("read")
+                    rl += 1
                     try:
-                        ljson = json.loads(l)
-                        if "netscalerHttpReqMethod" in ljson["netflow"]:
-                            if ljson["netflow"]["netscalerHttpReqMethod"] in ["POST", "GET", "HEAD", "OPTIONS"]:
-                                if ljson["netflow"]["netscalerTransactionId"] in state["res"]:
-                                    logger.debug("Transaction ID {0} found in response state, writing out".format(ljson["netflow"]["netscalerTransactionId"]))
-                                    # if the response is already known, write immediately
-                                    outline = ljson
-                                    outline["netflow"]["netscalerHttpRspStatus"] = state["res"][ljson["netflow"]["netscalerTransactionId"]]["netflow"]["netscalerHttpRspStatus"]
-                                    apacheline = ipfixout.format_log_line(outline, args)
-                                    o.write(apacheline + os.linesep)
-                                    wl += 1
-                                    
-                                    # remove from state tables
-                                    del(state["res"][ljson["netflow"]["netscalerTransactionId"]])
-                                elif ljson["netflow"]["netscalerTransactionId"] not in state["req"]:
-                                    logger.debug("New Transaction ID {0} found, adding to table".format(ljson["netflow"]["netscalerTransactionId"]))
-                                    # check size of state table, purge old data if full
-                                    while len(state["req"]) > args.maxstate:
-                                        outline = state["req"].popitem(last=False)[1]
-                                        logger.debug("Max request state size reached, writing out Transaction ID {0}".format(ljson["netflow"]["netscalerTransactionId"]))
-                                        # set placeholder response code and write to file
-                                        outline["netflow"]["netscalerHttpRspStatus"] = 0
-                                        apacheline = ipfixout.format_log_line(outline, args)
-                                        o.write(apacheline + os.linesep)
-                                        wl += 1
-                                    # add new state line
-                                    state["req"][ljson["netflow"]["netscalerTransactionId"]] = ljson
-                                    logger.debug("req state size is {0}".format(len(state["req"])))
-                        if "netscalerHttpRspStatus" in ljson["netflow"]:
-                            if ljson["netflow"]["netscalerTransactionId"] in state["req"]:
-                                logger.debug("Transaction ID {0} found in request state, writing out".format(ljson["netflow"]["netscalerTransactionId"]))
-                                # if request is present in state table, write immediately
-                                outline = state["req"][ljson["netflow"]["netscalerTransactionId"]]
-                                #outline["netscalerHttpRspStatus"] = state["res"][ljson["netflow"]["netscalerTransactionId"]]["netscalerHttpRspStatus"]
-                                outline["netflow"]["netscalerHttpRspStatus"] = ljson["netflow"]["netscalerHttpRspStatus"]
-                                apacheline = ipfixout.format_log_line(outline, args)
-                                o.write(apacheline + os.linesep)
-                                wl += 1
-                            
-                                # remove from state tables
-                                del(state["req"][ljson["netflow"]["netscalerTransactionId"]])
-                            else:
-                                # check size of state table, purge old data if full
-                                while len(state["res"]) > args.maxstate * 5:
-                                    logger.debug("Max response state size reached, purging oldest flow")
-                                    state["res"].popitem(last=False)
-                                state["res"][ljson["netflow"]["netscalerTransactionId"]] = ljson
-                                logger.debug("res state size is {0}".format(len(state["res"])))
-                            
-
+                        ljson = decoder.decode(l)
+                        laps.lap("decode")
+                        if ljson is not None:
+                            completed = state.feed(ljson)
+                            laps.lap("correlate")
+                            wl += write_completed(completed, writer, outname, args)
+                            laps.lap("write")
                     except Exception as e:
                         exc_type, exc_value, exc_tb = sys.exc_info()
                         traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
                         ex += 1
-                        if 'outline' in locals():
-                            sys.stderr.write(json.dumps(outline) + "\n")
+                    # only ever step past complete lines
+                    last_position = endpos
+            finally:
+                if own_writer:
+                    writer.close()
+                laps.lap("write")
+            record_metrics(state, laps, evicted, dropped, source_name(os.path.dirname(path)))
+            logger.debug("Read {0} lines from {1}".format(rl, path))
+            logger.debug("Rejected {0} non-HTTP lines, decoded {1}".format(decoder.rejected, decoder.decoded))
             logger.debug("Exception on {0} lines".format(ex))
         except Exception as e:
             exc_type, exc_value, exc_tb = sys.exc_info()
@@ -93,15 +170,159 @@ def process_file(path, position, state, args):
             logger.debug("Exception reached, skipping")
             pass
         finally:
-            return {"filepos": last_position, "written": wl, "outname": outname}
-
-def files_to_read(currentfpath):
+            LINES_READ.inc(rl)
+            LINES_REJECTED.inc(decoder.rejected)
+            LINES_DECODED.inc(decoder.decoded)
+            LINE_ERRORS.inc(ex)
+            ROWS_WRITTEN.inc(wl)
+            return {"filepos": last_position, "written": wl, "outname": outname, "rejected": decoder.rejected, "decoded": decoder.decoded}
+
+def split_file(path, position, segsize):
+    """Split path after position into (start, end) byte ranges of about
+    segsize bytes, each starting on a line boundary. The last range is open
+    ended so that it picks up the final position like process_file does."""
+    segments = []
+    size = os.path.getsize(path)
+    start = position
+    with open(path, 'rb') as f:
+        while start + segsize < size:
+            f.seek(start + segsize)
+            f.readline()
+            end = f.tell()
+            if end >= size:
+                break
+            segments.append((start, end))
+            start = end
+    segments.append((start, None))
+    return segments
+
+def decode_segment(path, start, end, args):
+    """Read and decode one file segment, returning the trimmed HTTP records
+    in file order. Runs in a catch-up worker process."""
+    decoder = decode.Decoder(decode.HTTP_KEYS)
+    records = []
+    last_position = start
+    rl = 0
+    ex = 0
+    with open(path, 'rb') as f:
+        for l, endpos in read_lines(f, start, args.readchunk, args.mmap, end):
+            rl += 1
+            try:
+                ljson = decoder.decode(l)
+                if ljson is not None:
+                    records.append(transactions.trim(ljson))
+            except Exception as e:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
+                ex += 1
+            last_position = endpos
+    return {"records": records, "filepos": last_position, "lines": rl, "errors": ex,
+            "rejected": decoder.rejected, "decoded": decoder.decoded}
+
+def decode_lines(lines):
+    """Decode a batch of lines read by the live pipeline, returning the
+    trimmed HTTP records in order. Runs in a worker process with -j."""
+    decoder = decode.Decoder(decode.HTTP_KEYS)
+    records = []
+    ex = 0
+    for l in lines:
+        try:
+            ljson = decoder.decode(l)
+            if ljson is not None:
+                records.append(transactions.trim(ljson))
+        except Exception as e:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
+            ex += 1
+    return {"records": records, "lines": len(lines), "errors": ex,
+            "rejected": decoder.rejected, "decoded": decoder.decoded}
+
+def catch_up(files, saved, state, writer, ckpt, posfile, args):
+    """Process backlog files with reading and decoding spread across a
+    process pool, the file in saved from its saved position (see
+    start_position()).
+
+    Files are cut into segments which workers decode in parallel, but the
+    decoded records are fed to the state table and written in file order in
+    this process, so transactions crossing hour boundaries are still matched
+    and the output and saved positions are the same as a sequential run.
+    Returns the last position saved.
+    """
+    posdata = None
+    setattr(args, "with_srcip", True)
+    setattr(args, "with_dstip", True)
+    tasks = []
+    for path in files:
+        segments = split_file(path, start_position(path, saved), args.segsize)
+        for i, (start, end) in enumerate(segments):
+            tasks.append((path, start, end, i == len(segments) - 1))
+    logger.info("Decoding {0} segments from {1} files with {2} workers".format(len(tasks), len(files), args.jobs))
+
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        # keep a bounded number of segments in flight so decoded records
+        # cannot pile up faster than they are written
+        tasks = iter(tasks)
+        pending = collections.deque()
+        for task in tasks:
+            pending.append((task, pool.apply_async(decode_segment, (task[0], task[1], task[2], args))))
+            if len(pending) >= args.jobs * 2:
+                break
+        wl = 0
+        ex = 0
+        while pending:
+            (path, start, end, last), result = pending.popleft()
+            for task in tasks:
+                pending.append((task, pool.apply_async(decode_segment, (task[0], task[1], task[2], args))))
+                break
+            segment = result.get()
+            outname = output_name(path, args)
+            ex += segment["errors"]
+            laps = metrics.Laps()
+            evicted, dropped = state.evicted, state.dropped
+            segwl = 0
+            for ljson in segment["records"]:
+                try:
+                    completed = state.feed(ljson)
+                    laps.lap("correlate")
+                    segwl += write_completed(completed, writer, outname, args)
+                    laps.lap("write")
+                except Exception as e:
+                    exc_type, exc_value, exc_tb = sys.exc_info()
+                    traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
+                    ex += 1
+            wl += segwl
+            record_metrics(state, laps, evicted, dropped, source_name(os.path.dirname(path)))
+            LINES_READ.inc(segment["lines"])
+            LINES_REJECTED.inc(segment["rejected"])
+            LINES_DECODED.inc(segment["decoded"])
+            LINE_ERRORS.inc(segment["errors"])
+            ROWS_WRITTEN.inc(segwl)
+            logger.debug("Read {0} lines from {1} at {2}, rejected {3} non-HTTP lines, decoded {4}".format(
+                segment["lines"], path, start, segment["rejected"], segment["decoded"]))
+            if last:
+                writer.checkpoint()
+                posdata = {"path": path, "position": segment["filepos"]}
+                save_position(posdata, state, ckpt, posfile)
+        logger.info("Caught up: wrote {0} lines, exception on {1} lines".format(wl, ex))
+    finally:
+        pool.close()
+        pool.join()
+    return posdata
+
+def new_state(args, name="ipfix"):
+    return transactions.TransactionTable(args.maxstate, args.maxstate * 5, args.statettl, spill.open_store(args, name))
+
+def new_writer(args):
+    return writers.HourlyWriter(args.flushlines, args.flushms, args.fsync, binary=get_formatter(args).binary)
+
+def files_to_read(currentfpath, watchpath):
     sdate = datetime.datetime.strptime("1970-01-01", "%Y-%m-%d")
     cdate = datetime.datetime.utcnow().replace(microsecond=0,second=0,minute=0)
     if currentfpath:
         basename = os.path.basename(currentfpath)
         sdate = datetime.datetime.strptime(basename.split("_")[0], "%Y-%m-%d.%H")
-    allfiles = glob.glob("/var/log/logstash/*_json.log")
+    allfiles = glob.glob(os.path.join(watchpath, "*_json.log"))
     allfiles.sort(key=os.path.getmtime)
     ftr = []
     for f in allfiles:
@@ -111,34 +332,121 @@ def files_to_read(currentfpath):
             ftr.append(f)
 
     return ftr
-    
-    
+
+def start_position(path, posdata):
+    """Where to start reading a backlog file: the saved position for the
+    file it was saved in, the beginning for any other."""
+    if path == posdata["path"]:
+        return posdata["position"]
+    return 0
+
+def source_name(watchpath):
+    """Name a watched directory for use in checkpoint and position file names."""
+    return os.path.abspath(watchpath).strip("/").replace("/", "_")
+
+class Output(object):
+    """The output files, shared by the live pipelines of every source.
+
+    Each pipeline's last stage puts (handler, outname, lines, rows, posdata,
+    prepared) here, and a single write stage writes the lines out, and rows
+    to the archive if there is one, then flushes and applies the handler's
+    checkpoint so its saved position never runs ahead of the output. While
+    nothing arrives it writes any archive blocks that have waited long enough.
+    """
+    def __init__(self, args):
+        self.writer = new_writer(args)
+        self.archive = get_archive(args)
+        idle = self.archive.age if self.archive is not None else None
+        self.pipeline = pipeline.Pipeline([pipeline.Stage("write", self.write_batch, args.queuesize, idle)], QUEUE_DEPTH)
+
+    def start(self):
+        self.pipeline.start()
+
+    def put(self, item):
+        self.pipeline.put(item)
+
+    def close(self):
+        """Write out everything queued, then close the files. The pipelines
+        feeding this must be stopped first."""
+        self.pipeline.close()
+        self.writer.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    def write_batch(self, item):
+        handler, outname, lines, rows, posdata, prepared = item
+        laps = metrics.Laps()
+        for line in lines:
+            self.writer.write(outname, line)
+        ROWS_WRITTEN.inc(len(lines))
+        if rows:
+            self.archive.add(rows)
+            laps.lap("archive")
+        if prepared is not None:
+            self.writer.checkpoint()
+            handler.checkpoint.apply(prepared)
+            writepos(posdata, handler.posfile)
+            logger.debug("Saved position {0} in {1}".format(posdata["position"], posdata["path"]))
+        laps.lap("write")
+        record_laps(laps)
+
 
 class NetscalerParse(RegexMatchingEventHandler):
+    """Live processing of the current hour's file, as a pipeline of stages
+    each in its own thread:
+
+      read       the tail scheduler thread reads complete lines in batches
+      decode     decodes each batch inline, or hands it to a process pool
+                 with -j, keeping batches in order
+      correlate  feeds records to the state table, formats completed
+                 transactions and prepares a checkpoint after each read
+      write      the Output shared with any other sources
+
+    With partitions, decode and correlate are replaced by:
+
+      route      sends each line to the partition owning its transaction ID
+      collect    gathers the partitions' output and state changes back into
+                 batch order and prepares the checkpoint
+
+    The stages are joined by bounded queues, so a slow stage makes the ones
+    before it wait rather than stalling everything or buffering without limit.
+    """
     def __init__(self, *args, **kwargs):
         src_args = kwargs.pop("srcargs")
+        state = kwargs.pop("state")
+        ckpt = kwargs.pop("checkpoint")
+        posdata = kwargs.pop("posdata")
+        # one handler runs per watched directory; source is its index and
+        # label tells its stages apart from other sources'
+        self.watchpath = kwargs.pop("watchpath", src_args.watchpath[0])
+        self.posfile = kwargs.pop("posfile", src_args.posfile)
+        self.source = kwargs.pop("source", 0)
+        self.sourcename = source_name(self.watchpath)
+        label = kwargs.pop("label", "")
+        output = kwargs.pop("output", None)
+        self.partitions = kwargs.pop("partitions", None)
         super(self.__class__, self).__init__(*args, **kwargs)
         self.src_args = src_args
-        self._last_position = getpos(src_args.posfile)["position"]
-        self._last_event_path = ""
-        self.state = {"req": collections.OrderedDict(), "res": collections.OrderedDict()}
-        self._statefile = os.path.join(self.src_args.outpath, "ipfix.state")
-        self.load_state()
+        self._last_position = posdata["position"]
+        self._last_event_path = posdata["path"]
+        self.state = state
+        self.checkpoint = ckpt
+        self._own_output = output is None
+        self.output = Output(src_args) if output is None else output
+        self.scheduler = tail.TailScheduler(self.process_current, src_args.batchms / 1000.0, src_args.maxbatchms / 1000.0,
+                                            src_args.batchbytes, src_args.maxbatchbytes, src_args.poll)
+        if self.partitions is None:
+            stages = [pipeline.Stage("decode" + label, self.decode_batch, src_args.queuesize),
+                      pipeline.Stage("correlate" + label, self.correlate_batch, src_args.queuesize)]
+        else:
+            stages = [pipeline.Stage("route" + label, self.route_batch, src_args.queuesize),
+                      pipeline.Stage("collect" + label, self.collect_batch, src_args.queuesize)]
+        self.pipeline = pipeline.Pipeline(stages, QUEUE_DEPTH, sink=self.output)
+        self.pool = None
         signal.signal(signal.SIGTERM, self.breakout)
         signal.signal(signal.SIGINT, self.breakout)
         self.exit_now = False
 
-    def load_state(self):
-        if (os.path.exists(self._statefile)):
-            with open(self._statefile, 'r') as f:
-                oldstate = json.load(f)
-                for oldreqid, oldreq in oldstate["req"].items():
-                    self.state["req"][oldreqid] = oldreq
-                for oldresid, oldres in oldstate["res"].items():
-                    self.state["res"][oldresid] = oldres
-            logger.info("Loaded req[{0}] res[{1}] from state file".format(len(self.state["req"]), len(self.state["res"])))
-            os.remove(self._statefile)
-
 #    def on_created(self, event):
 #        self._last_position = 0
 #        self._last_event_path = event.src_path
@@ -147,29 +455,191 @@ class NetscalerParse(RegexMatchingEventHandler):
 
     # initialise session tracking array
 
-    def on_modified(self, event):
+    def start(self):
+        if self.partitions is not None:
+            # the partitions hold the state from here on
+            self.partitions.restore(self.source, self.state)
+            self.state.close()
+        elif self.src_args.jobs > 1:
+            self.pool = multiprocessing.Pool(self.src_args.jobs)
+        if self._own_output:
+            self.output.start()
+        self.pipeline.start()
+
+    def stop(self):
+        """Stop reading, then let everything already read through the
+        pipeline."""
+        self.scheduler.stop()
+        self.pipeline.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        if self._own_output:
+            self.output.close()
+
+    def current_file(self):
         currenthour = datetime.datetime.utcnow().strftime("%Y-%m-%d.%H")
-        currentfile = os.path.join(self.src_args.watchpath, currenthour + "_json.log")
-        if event.src_path == currentfile:
-            if self._last_position > os.path.getsize(event.src_path):
-                logger.debug("Event file is smaller than last position - must be new file")
-                self._last_position = 0
-                logger.info("Now reading from file {0}".format(event.src_path))
-            if self._last_event_path != event.src_path:
-                logger.debug("Event file is different from previous event file")
-                self._last_event_path = event.src_path
-            logger.debug("Reading at position {0}".format(self._last_position))
-            results = process_file(event.src_path, self._last_position, self.state, self.src_args)
-            self._last_position = results["filepos"]
-            if results["written"] > 0:
-                writepos({"path": event.src_path, "position": self._last_position}, self.src_args.posfile)
-            logger.debug("Wrote {0} lines to {1}".format(results["written"], results["outname"]))
-            q.put({"rows written": results["written"], "state": {"req": len(self.state["req"]), "res": len(self.state["res"])}})
-
-            self._last_event_path = event.src_path
+        return os.path.join(self.watchpath, currenthour + "_json.log")
+
+    def on_modified(self, event):
+        if event.src_path == self.current_file():
+            # the read itself happens on the scheduler thread, so bursts of
+            # events are merged into one read
+            self.scheduler.notify()
         else:
             logger.debug("Event received on non current file - skipping {0}".format(event.src_path))
 
+    def process_current(self, maxbytes):
+        """Read up to maxbytes from the current hour's file into the pipeline,
+        or if maxbytes is None the next line whatever its length. Returns the
+        number of bytes consumed and the number left unread.
+
+        Once the hour changes, the previous hour's file is read to its end
+        before the new one is started."""
+        path = self.current_file()
+        previous = self._last_event_path
+        if previous != path and os.path.exists(previous) and self._last_position < os.path.getsize(previous):
+            consumed, remaining = self.read_batch(previous, maxbytes)
+            if consumed or (maxbytes is not None and remaining >= maxbytes):
+                if os.path.exists(path):
+                    remaining += os.path.getsize(path)
+                LAG_BYTES.set(remaining, source=self.sourcename)
+                return consumed, remaining
+            logger.warning("Skipping incomplete last line of {0}".format(previous))
+        if not os.path.exists(path):
+            return 0, 0
+        if previous != path or self._last_position > os.path.getsize(path):
+            logger.debug("Event file is different from previous event file or smaller than last position - must be new file")
+            self._last_position = 0
+            self._last_event_path = path
+            logger.info("Now reading from file {0}".format(path))
+        consumed, remaining = self.read_batch(path, maxbytes)
+        LAG_BYTES.set(remaining, source=self.sourcename)
+        return consumed, remaining
+
+    def read_batch(self, path, maxbytes):
+        """Read up to maxbytes from path at the last position, as for
+        process_current()."""
+        logger.debug("Reading at position {0}".format(self._last_position))
+        startpos = self._last_position
+        laps = metrics.Laps()
+        lines = []
+        end = None if maxbytes is None else startpos + maxbytes
+        with open(path, 'rb') as f:
+            for l, endpos in read_lines(f, startpos, self.src_args.readchunk, self.src_args.mmap, end):
+                lines.append(l)
+                self._last_position = endpos
+                if end is None:
+                    break
+                if len(lines) >= self.src_args.batchlines:
+                    self.enqueue(path, lines, False, laps)
+                    lines = []
+        if self._last_position != startpos:
+            # the last batch of a read carries the checkpoint
+            self.enqueue(path, lines, True, laps)
+        record_laps(laps)
+        return self._last_position - startpos, max(0, os.path.getsize(path) - self._last_position)
+
+    def enqueue(self, path, lines, last, laps):
+        laps.lap("read")
+        self.pipeline.put((path, lines, self._last_position, last))
+        # time spent waiting for room in the queue
+        laps.lap("backpressure")
+
+    def decode_batch(self, item):
+        path, lines, endpos, last = item
+        if self.pool is not None:
+            return path, endpos, last, self.pool.apply_async(decode_lines, (lines,))
+        laps = metrics.Laps()
+        result = pipeline.Ready(decode_lines(lines))
+        laps.lap("decode")
+        record_laps(laps)
+        return path, endpos, last, result
+
+    def correlate_batch(self, item):
+        path, endpos, last, result = item
+        laps = metrics.Laps()
+        decoded = result.get()
+        laps.lap("decode")
+        outname = output_name(path, self.src_args)
+        formatter = get_formatter(self.src_args)
+        evicted, dropped = self.state.evicted, self.state.dropped
+        ex = decoded["errors"]
+        lines = []
+        rows = [] if self.src_args.archive else None
+        for ljson in decoded["records"]:
+            try:
+                completed = self.state.feed(ljson)
+                for t in completed:
+                    lines.append(formatter.format(t) + formatter.newline)
+                if rows is not None:
+                    rows.extend(map(archive.row, completed))
+            except Exception as e:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_tb, limit=2, file=sys.stderr)
+                ex += 1
+        laps.lap("correlate")
+        posdata = {"path": path, "position": endpos}
+        prepared = None
+        if last:
+            prepared = self.checkpoint.prepare(posdata, self.state)
+            laps.lap("checkpoint")
+        record_metrics(self.state, laps, evicted, dropped, self.sourcename)
+        LINES_READ.inc(decoded["lines"])
+        LINES_REJECTED.inc(decoded["rejected"])
+        LINES_DECODED.inc(decoded["decoded"])
+        LINE_ERRORS.inc(ex)
+        if self.state.clock:
+            LAG_SECONDS.set(max(0, time.time() - self.state.clock), source=self.sourcename)
+        return self, outname, lines, rows, posdata, prepared
+
+    def route_batch(self, item):
+        path, lines, endpos, last = item
+        laps = metrics.Laps()
+        slices, rejected = self.partitions.split(self.source, lines)
+        want = None
+        if last:
+            # a snapshot needs the full state, so decide now whether this
+            # checkpoint is one and have the partitions send it back
+            want = "snapshot" if self.checkpoint.schedule() else "delta"
+        result = self.partitions.dispatch(self.source, slices, want)
+        laps.lap("route")
+        record_laps(laps)
+        return path, endpos, last, len(lines), rejected, result
+
+    def collect_batch(self, item):
+        path, endpos, last, count, rejected, result = item
+        laps = metrics.Laps()
+        results = result.get()
+        laps.lap("correlate")
+        outname = output_name(path, self.src_args)
+        lines = []
+        rows = [] if self.src_args.archive else None
+        for r in results:
+            lines.extend(r["lines"])
+            if rows is not None:
+                rows.extend(r["rows"])
+        posdata = {"path": path, "position": endpos}
+        prepared = None
+        if last:
+            view = partition.StateView(results)
+            prepared = self.checkpoint.prepare(posdata, view, snapshot="req_all" in results[0])
+            laps.lap("checkpoint")
+        record_laps(laps)
+        STAGE_SECONDS.inc(sum(r["seconds"] for r in results), stage="partition")
+        PLACEHOLDERS.inc(sum(r["evicted"] for r in results))
+        DROPPED.inc(sum(r["dropped"] for r in results))
+        for table in ("req", "res", "spill"):
+            record_state_size(self.sourcename, table, sum(r[table] for r in results))
+        LINES_READ.inc(count)
+        LINES_REJECTED.inc(rejected + sum(r["rejected"] for r in results))
+        LINES_DECODED.inc(sum(r["decoded"] for r in results))
+        LINE_ERRORS.inc(sum(r["errors"] for r in results))
+        clock = max(r["clock"] for r in results)
+        if clock:
+            LAG_SECONDS.set(max(0, time.time() - clock), source=self.sourcename)
+        return self, outname, lines, rows, posdata, prepared
+
     def breakout(self, signum, frame):
         self.exit_now = True
 
@@ -178,9 +648,13 @@ class NetscalerParse(RegexMatchingEventHandler):
         #outname = os.path.join(self.src_args.outpath, dstr + "-netscaler_http_apache.txt")
         #wl = 0
         
-        with open(self._statefile, 'w') as f:
-            f.write(json.dumps(self.state))
-            logger.info("State: req[{0}], res[{1}] written to {2}".format(len(self.state["req"]), len(self.state["res"]), self._statefile))
+        state = self.state
+        if self.partitions is not None:
+            state = self.partitions.dump(self.source)
+        # compact the journal so the next start only has a snapshot to load
+        self.checkpoint.snapshot({"path": self._last_event_path, "position": self._last_position}, state)
+        self.checkpoint.close()
+        self.state.close()
         #with open(outname, 'a') as o:
         #    for item, r in self.state["req"].iteritems():
         #        apacheline = ipfixout.format_log_line(r, self.src_args)
@@ -190,9 +664,29 @@ class NetscalerParse(RegexMatchingEventHandler):
         #    logger.debug("State flush complete")
 
 def writepos(posdata, posfilepath):
-    with open(posfilepath, 'w') as f:
+    tmpfile = posfilepath + ".tmp"
+    with open(tmpfile, 'w') as f:
         pos = json.dumps(posdata)
         f.write(pos)
+    os.rename(tmpfile, posfilepath)
+
+def save_position(posdata, state, ckpt, posfile):
+    # the checkpoint journal is authoritative; the position file is kept up
+    # to date for anything else that reads it
+    ckpt.commit(posdata, state)
+    writepos(posdata, posfile)
+
+def load_legacy_state(state, posdata, ckpt, args):
+    """Migrate a state file written by earlier versions into a snapshot."""
+    statefile = os.path.join(args.outpath, "ipfix.state")
+    if os.path.exists(statefile):
+        with open(statefile, 'r') as f:
+            oldstate = json.load(f, object_pairs_hook=collections.OrderedDict)
+            state.load_dict(oldstate)
+        logger.info("Loaded req[{0}] res[{1}] from state file".format(len(state.req), len(state.res)))
+        # only remove the old file once its contents are safely in a snapshot
+        ckpt.snapshot(posdata, state)
+        os.remove(statefile)
 
 def getpos(posfilepath):
     if os.path.exists(posfilepath):
@@ -229,43 +723,91 @@ def stats_scheduler():
     s.run()
     return obj
     
+_last_stats = {}
+
 def stats():
-    written = 0
-    req = 0
-    res = 0
-    items = q.qsize()
-    for i in range(items):
-        val = q.get()
-        written += val["rows written"]
-        req += val["state"]["req"]
-        res += val["state"]["res"]
-    
-    avgreq = 0
-    avgres = 0
-    
-    if items > 0:
-        avgreq = float(req) / items
-        avgres = float(res) / items
-        
+    totals = {"written": ROWS_WRITTEN.value(), "rejected": LINES_REJECTED.value(), "decoded": LINES_DECODED.value()}
+    written, rejected, decoded = [totals[k] - _last_stats.get(k, 0) for k in ("written", "rejected", "decoded")]
+    _last_stats.update(totals)
+
     rate = float(written) / statstime
     ratestr = "{0:.2f}".format(rate)
     logger.info("{0} rows written, {1} messages/s average".format(written, ratestr))
-    logger.info("Average queue size: req[{0}], res[{1}]".format(avgreq,avgres))
-
-if __name__ == "__main__":
+    logger.info("{0} lines rejected before decoding, {1} lines decoded with {2}".format(rejected, decoded, decode.backend))
+    for watchpath in watchpaths:
+        source = source_name(watchpath)
+        where = " in {0}".format(watchpath) if len(watchpaths) > 1 else ""
+        size = dict((table, STATE_SIZE.value(source=source, table=table)) for table in ("req", "res", "spill"))
+        highest = dict((table, STATE_SIZE_MAX.value(source=source, table=table)) for table in ("req", "res", "spill"))
+        logger.info("State size{0}: req[{1}], res[{2}], highest req[{3}], res[{4}]".format(
+            where, size["req"], size["res"], highest["req"], highest["res"]))
+        if highest["spill"]:
+            logger.info("Spilled to disk{0}: {1}, highest {2}".format(where, size["spill"], highest["spill"]))
+        logger.info("Behind end of input{0} by {1} bytes".format(where, LAG_BYTES.value(source=source)))
+    if metricsfile:
+        metrics.write_file(metricsfile)
+
+def make_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument("watchpath", help="Path to watch for new files")
+    parser.add_argument("watchpath", nargs="+", help="Paths to watch for new files, one per Logstash source")
     parser.add_argument("--position-file", dest="posfile", default="/var/log/apache/track.pos", help="File to store position information in")
     parser.add_argument("-l", dest="loglevel", default="INFO")
     parser.add_argument("-o", dest="outpath", default="/var/log/apache/")
+    parser.add_argument("--archive", dest="archive", help="Also write every output row to an hourly indexed archive in this directory, \
+for lookups with archive.py query")
+    parser.add_argument("-f", "--format", dest="format", default="apache", choices=sorted(formats.FORMATS), help="Output format")
+    parser.add_argument("--fields", dest="fields", help="Comma separated fields to output, for formats other than apache \
+(default {0})".format(",".join(formats.DEFAULT_FIELDS)))
     parser.add_argument("--max-state", dest="maxstate", default=1000, type=int, help="Maximum HTTP request records to hold in memory before flushing out. \
 Records with no matching response will have placeholder values in the output.")
+    parser.add_argument("--state-ttl", dest="statettl", default=0, type=int, help="Write out pending HTTP requests with placeholder values once they are (n) seconds \
+older than the newest record seen. Disabled by default.")
+    parser.add_argument("--spill", dest="spill", action="store_true", help="Move requests and responses over --max-state to an on-disk store \
+in the output directory, where they can still be matched, instead of writing them out with placeholder values")
+    parser.add_argument("--spill-ttl", dest="spillttl", default=600, type=int, help="Write out spilled requests with placeholder values once they \
+are (n) seconds older than the newest record seen, 0 to disable")
+    parser.add_argument("--spill-max", dest="spillmax", default=10000000, type=int, help="Write out the oldest spilled requests once more than (n) \
+requests and responses are spilled, 0 for no limit")
     parser.add_argument("-t", dest="statstime", default=60, help="Output statistics to stderr every (n) seconds")
+    parser.add_argument("--poll", dest="poll", action="store_true", help="Poll the current file for new data instead of waiting for filesystem events")
+    parser.add_argument("--batch-ms", dest="batchms", default=50, type=int, help="Wait (n) milliseconds after a modify event to merge a burst of events \
+into one read, or poll every (n) milliseconds with --poll")
+    parser.add_argument("--max-batch-ms", dest="maxbatchms", default=1000, type=int, help="Upper limit for the wait when it grows while behind")
+    parser.add_argument("--batch-bytes", dest="batchbytes", default=1048576, type=int, help="Read at most (n) bytes per batch when keeping up")
+    parser.add_argument("--max-batch-bytes", dest="maxbatchbytes", default=67108864, type=int, help="Upper limit for the batch size when it grows while behind")
+    parser.add_argument("--metrics-port", dest="metricsport", default=0, type=int, help="Serve Prometheus metrics on this port, 0 to disable")
+    parser.add_argument("--metrics-host", dest="metricshost", default="127.0.0.1", help="Address to serve metrics on")
+    parser.add_argument("--metrics-file", dest="metricsfile", help="Also write Prometheus metrics to this file every statistics interval")
+    parser.add_argument("--read-chunk", dest="readchunk", default=1048576, type=int, help="Read input files in chunks of (n) bytes")
+    parser.add_argument("--mmap", dest="mmap", action="store_true", help="Read input files through mmap instead of chunked reads")
+    parser.add_argument("-j", "--jobs", dest="jobs", default=1, type=int, help="Worker processes used to decode backlog files at startup, \
+and live batches")
+    parser.add_argument("--queue-size", dest="queuesize", default=64, type=int, help="Batches each live pipeline stage may have waiting \
+before the stage in front of it blocks")
+    parser.add_argument("--batch-lines", dest="batchlines", default=1000, type=int, help="Lines per live pipeline batch")
+    parser.add_argument("--partitions", dest="partitions", default=1, type=int, help="Spread live correlation of every source over (n) worker \
+processes by transaction ID. --max-state is divided between them.")
+    parser.add_argument("--segment-size", dest="segsize", default=67108864, type=int, help="Split backlog files into segments of about (n) bytes \
+for the catch-up workers")
+    parser.add_argument("--snapshot-every", dest="snapshotevery", default=1000, type=int, help="Compact the state journal into a snapshot \
+after (n) checkpoints")
+    parser.add_argument("--flush-lines", dest="flushlines", default=1000, type=int, help="Flush output after (n) buffered lines, 0 to disable")
+    parser.add_argument("--flush-ms", dest="flushms", default=1000, type=int, help="Flush output (n) milliseconds after the last flush, 0 to disable")
+    parser.add_argument("--fsync", dest="fsync", default="checkpoint", choices=writers.FSYNC_POLICIES, help="When to fsync output files: never, on every flush, \
+or when the input position is saved")
+    return parser
+
+if __name__ == "__main__":
+    parser = make_parser()
 
     fmt = '%(asctime)s - %(message)s'
     dfmt = '%Y-%m-%d %H:%M:%S'
 
     args = parser.parse_args()
+    try:
+        get_formatter(args)
+    except ValueError as e:
+        parser.error(str(e))
 
     lvl = getattr(logging, args.loglevel)
 
@@ -277,38 +819,84 @@ Records with no matching response will have placeholder values in the output.")
     formatter = logging.Formatter(fmt, datefmt=dfmt)
     ch.setFormatter(formatter)
     logger.addHandler(ch)
+    for module in (transactions, writers, checkpoint, metrics, tail, pipeline, partition):
+        logging.getLogger(module.__name__).setLevel(lvl)
+        logging.getLogger(module.__name__).addHandler(ch)
 
-    logger.info("Starting preprocessing")
-    
-    # identify which files have not yet been processed
-    ftr = []
-    posdata = {"path": "", "position": 0}
-
-    if not os.path.exists(args.posfile):
-        ftr = files_to_read("")
-    else:
-        posdata = getpos(args.posfile)
-        ftr = files_to_read(posdata["path"])
+    metricsfile = args.metricsfile
+    if args.metricsport:
+        metrics.serve(args.metricshost, args.metricsport)
 
-    logger.info("{0} files to process since last position update".format(len(ftr)))
+    logger.info("Starting preprocessing")
 
-    # initialise session tracking array
-    reconstructor = {"req": collections.OrderedDict(), "res": collections.OrderedDict()}
+    sources = watchpaths = args.watchpath
+    partitions = None
+    if args.partitions > 1:
+        partitions = partition.Partitions(args.partitions, len(sources), args)
+    output = Output(args)
+    backlog_writer = new_writer(args)
+    handlers = []
+
+    for i, watchpath in enumerate(sources):
+        # a single source keeps the names earlier versions used
+        ckptname, posfile, label = "ipfix", args.posfile, ""
+        if len(sources) > 1:
+            name = source_name(watchpath)
+            root, ext = os.path.splitext(args.posfile)
+            ckptname, posfile, label = "ipfix-" + name, root + "-" + name + ext, "-{0}".format(i)
+
+        # initialise session tracking array
+        reconstructor = new_state(args, ckptname)
+        ckpt = checkpoint.Checkpoint(args.outpath, args.snapshotevery, ckptname)
+
+        # identify which files have not yet been processed
+        ftr = []
+        posdata = ckpt.load(reconstructor)
+
+        if posdata is None:
+            posdata = {"path": "", "position": 0}
+            if os.path.exists(posfile):
+                posdata = getpos(posfile)
+            if len(sources) == 1:
+                load_legacy_state(reconstructor, posdata, ckpt, args)
+
+        ftr = files_to_read(posdata["path"], watchpath)
+
+        logger.info("{0} files to process in {1} since last position update".format(len(ftr), watchpath))
+
+        if args.jobs > 1:
+            posdata = catch_up(ftr, posdata, reconstructor, backlog_writer, ckpt, posfile, args) or posdata
+        else:
+            saved = posdata
+            for oldfile in ftr:
+                results = process_file(oldfile, start_position(oldfile, saved), reconstructor, args, backlog_writer)
+                posdata = {"path": oldfile, "position": results["filepos"]}
+                backlog_writer.checkpoint()
+                save_position(posdata, reconstructor, ckpt, posfile)
 
-    for oldfile in ftr:
-        results = process_file(oldfile, posdata["position"], reconstructor, args)
-        postdata = {"path": oldfile, "position": results["filepos"]}
-        writepos(postdata, args.posfile)
+        handlers.append(NetscalerParse(regexes=[r'.*\_json.log'], srcargs=args, state=reconstructor, checkpoint=ckpt, posdata=posdata,
+                                       watchpath=watchpath, posfile=posfile, source=i, label=label, output=output, partitions=partitions))
 
-    del(reconstructor)
+    backlog_writer.close()
 
     logger.info("Processed old data; proceeding to live")
     
-    event_handler = NetscalerParse(regexes=[r'.*\_json.log'], srcargs=args)
+    if partitions is not None:
+        partitions.start()
+    output.start()
     observer = Observer()
-    observer.schedule(event_handler, args.watchpath, recursive=False)
-    logger.info("Starting watcher")
-    observer.start()
+    for event_handler in handlers:
+        if not args.poll:
+            observer.schedule(event_handler, event_handler.watchpath, recursive=False)
+        else:
+            logger.info("Polling {0} every {1}ms".format(event_handler.watchpath, args.batchms))
+        event_handler.start()
+        event_handler.scheduler.start()
+        # pick up anything written while the backlog was processed
+        event_handler.scheduler.notify()
+    if not args.poll:
+        logger.info("Starting watcher")
+        observer.start()
     
     statstime = int(args.statstime)
     ctr = Monitor(statstime)
@@ -318,14 +906,23 @@ Records with no matching response will have placeholder values in the output.")
     try:
         while True:
             time.sleep(1)
-            if event_handler.exit_now:
+            if any(h.exit_now for h in handlers):
                 raise KeyboardInterrupt
     except KeyboardInterrupt:
         logger.error("Interrupt received")
-        observer.stop()
+        if not args.poll:
+            observer.stop()
+        # finish what has been read before saving state
+        for event_handler in handlers:
+            event_handler.stop()
         ctr.stop()
-        logger.debug("Position: {0}".format(event_handler._last_position))
-        event_handler.flush_state()
+        output.close()
+        for event_handler in handlers:
+            logger.debug("Position: {0} in {1}".format(event_handler._last_position, event_handler._last_event_path))
+            event_handler.flush_state()
+        if partitions is not None:
+            partitions.stop()
         
-    observer.join()
+    if not args.poll:
+        observer.join()
     logger.info("Shutdown complete")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import os, time, logging
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ("none", "flush", "checkpoint")
+
+class HourlyWriter(object):
+    """Keep the current hourly output file open and batch lines into large writes.
+
+    Lines are held in memory and written out once flush_lines have built up,
+    or once flush_ms milliseconds have passed since the last flush (either
+    limit can be disabled with 0). checkpoint() always flushes, and should be
+    called before recording an input position so that the position never gets
+    ahead of the output. fsync controls when data is forced to disk: never,
+    on every flush, or only on checkpoint. Writing to a different file name
+    closes the previous file, which is how the hourly rotation happens.
+    With binary set, lines are bytes and files are opened in binary mode.
+    """
+    def __init__(self, flush_lines=1000, flush_ms=1000, fsync="checkpoint", bufsize=1048576, binary=False):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy {0}".format(fsync))
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_ms / 1000.0
+        self.fsync = fsync
+        self.bufsize = bufsize
+        self.mode = 'ab' if binary else 'a'
+        self._empty = b"" if binary else ""
+        self.outname = None
+        self._file = None
+        self._pending = []
+        self._last_flush = time.time()
+
+    def write(self, outname, line):
+        if outname != self.outname:
+            self.rotate(outname)
+        self._pending.append(line)
+        if self.flush_lines and len(self._pending) >= self.flush_lines:
+            self.flush()
+        elif self.flush_interval and time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def rotate(self, outname):
+        self.close()
+        logger.debug("Opening output file {0}".format(outname))
+        self._file = open(outname, self.mode, self.bufsize)
+        self.outname = outname
+
+    def flush(self, sync=False):
+        if self._file is None:
+            return
+        if self._pending:
+            self._file.write(self._empty.join(self._pending))
+            self._pending = []
+        self._file.flush()
+        if sync or self.fsync == "flush":
+            os.fsync(self._file.fileno())
+        self._last_flush = time.time()
+
+    def checkpoint(self):
+        self.flush(sync=self.fsync != "none")
+
+    def close(self):
+        if self._file is not None:
+            self.checkpoint()
+            self._file.close()
+            logger.debug("Closed output file {0}".format(self.outname))
+        self._file = None
+        self.outname = None